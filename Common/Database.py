@@ -9,9 +9,119 @@ __version__ = "1.0.0"
 import io
 import datetime
 import logging
+import threading
+import time
+from contextlib import contextmanager
 from mysql.connector import connect, Error
 from getpass import getpass
 import DateTools
+from Timer import Timer
+
+
+class ConnectionPool:
+    """Thread-safe pool of reusable MySQL connections, one pool per host/database/user."""
+    log = logging.getLogger('ConnectionPool')
+    _pools = {}
+    _lock = threading.Lock()
+
+    def __init__(self, host: str, dbname: str, user: str, pwd: str, maxSize=4):
+        """Constructor. Use getPool to share pools between Database objects."""
+        self.host = host
+        self.dbname = dbname
+        self.user = user
+        self.pwd = pwd
+        self.maxSize = maxSize
+        self.idle = []
+        self.nInUse = 0
+        self.cond = threading.Condition()
+        self.resetStats()
+
+    @classmethod
+    def getPool(cls, host: str, dbname: str, user: str, pwd: str) -> 'ConnectionPool':
+        """Get or create the shared pool for the specified connection parameters."""
+        key = (host, dbname, user)
+        with cls._lock:
+            pool = cls._pools.get(key)
+            if pool is None:
+                pool = ConnectionPool(host, dbname, user, pwd)
+                cls._pools[key] = pool
+            return pool
+
+    @classmethod
+    def closeAll(cls):
+        """Close the idle connections of all pools."""
+        with cls._lock:
+            for pool in cls._pools.values():
+                pool.close()
+
+    @classmethod
+    def resetAfterFork(cls):
+        """Forget the pools inherited from a parent process, without closing 
+        their connections which are still used by the parent."""
+        cls._pools = {}
+        cls._lock = threading.Lock()
+
+    def acquire(self):
+        """Get a connection from the pool, opening one if needed.
+        Blocks while maxSize connections are in use."""
+        tStart = time.time()
+        with self.cond:
+            while not self.idle and self.nInUse >= self.maxSize:
+                self.cond.wait()
+            self.waitTime += time.time() - tStart
+            conn = self.idle.pop() if self.idle else None
+            self.nInUse += 1
+        try:
+            if conn is not None and conn.is_connected():
+                with self.cond:
+                    self.nReused += 1
+                return conn
+            conn = connect(host=self.host, user=self.user, password=self.pwd,
+                           database=self.dbname, autocommit=True)
+            with self.cond:
+                self.nOpened += 1
+                nOpened = self.nOpened
+            self.log.info('Opened connection %d to mysql:%s:%s', nOpened, self.host, self.dbname)
+            return conn
+        except Error:
+            self.release(None)
+            raise
+
+    def release(self, conn):
+        """Return a connection to the pool. A None connection only frees its slot."""
+        with self.cond:
+            self.nInUse -= 1
+            if conn is not None:
+                self.idle.append(conn)
+            self.cond.notify()
+
+    def close(self):
+        """Close all idle connections."""
+        with self.cond:
+            for conn in self.idle:
+                conn.close()
+            self.log.info('Closed %d idle connections to mysql:%s:%s', len(self.idle), self.host, self.dbname)
+            self.idle = []
+
+    def resetStats(self):
+        """Reset the pool statistics."""
+        self.nOpened = 0
+        self.nReused = 0
+        self.waitTime = 0.0
+
+    def getStats(self) -> dict:
+        """Get the pool statistics."""
+        return {
+            'opened': self.nOpened,
+            'reused': self.nReused,
+            'waitTime': self.waitTime,
+            'idle': len(self.idle),
+            'inUse': self.nInUse
+        }
+
+    def __str__(self):
+        return (f'ConnectionPool mysql:{self.host}:{self.dbname} opened: {self.nOpened} '
+                f'reused: {self.nReused} wait: {self.waitTime:.3f}s')
 
 
 class Database:
@@ -24,69 +134,158 @@ class Database:
         self.host = 'localhost'
         self.log.info('Constructor for mysql:%s:%s', self.host, self.dbname)
         self.conn = None
+        self.pool = None
+        self.nTransaction = 0
 
     def connect(self, user: str, pwd: str):
-        """Connect to the database."""
+        """Get a connection to the database from the connection pool."""
         if self.conn is not None:
             return
         try:
-            self.conn = connect(host=self.host, user=user, password=pwd, database=self.dbname)
-            self.log.info('Connected to mysql:%s:%s', self.host, self.dbname)
+            self.pool = ConnectionPool.getPool(self.host, self.dbname, user, pwd)
+            self.conn = self.pool.acquire()
+            self.log.debug('Connected to mysql:%s:%s', self.host, self.dbname)
         except Error as e:
             self.log.error('Failed to connect: %s', e)
 
     def disconnect(self):
-        """Disconnect from database."""
-        if self.conn is not None:
-            self.log.info('Disconnecting from mysql:%s:%s', self.host, self.dbname)
-            self.conn.close()
+        """Return our connection to the pool, unless a transaction is running."""
+        if self.conn is not None and self.nTransaction == 0:
+            self.log.debug('Disconnecting from mysql:%s:%s', self.host, self.dbname)
+            self.pool.release(self.conn)
             self.conn = None
 
-    def fetch(self, sql: str):
-        """Fetch records using the specified SQL."""
+    @contextmanager
+    def transaction(self, user: str, pwd: str):
+        """Context to group many statements into a single commit.
+        Keeps the connection until the outermost transaction ends,
+        rolls back if an exception is raised."""
+        self.connect(user, pwd)
+        if self.conn is None:
+            raise Error(msg=f'Not connected to mysql:{self.host}:{self.dbname}')
+        if self.nTransaction == 0:
+            self.conn.start_transaction()
+        self.nTransaction += 1
+        try:
+            yield self
+            if self.nTransaction == 1:
+                self.conn.commit()
+        except Exception:
+            if self.nTransaction == 1:
+                self.log.error('Rolling back transaction on mysql:%s:%s', self.host, self.dbname)
+                self.conn.rollback()
+            raise
+        finally:
+            self.nTransaction -= 1
+            self.disconnect()
+
+    def isInTransaction(self) -> bool:
+        """Check if a transaction is running."""
+        return self.nTransaction > 0
+
+    def getPoolStats(self) -> dict:
+        """Get the statistics of our connection pool, or None if never connected."""
+        if self.pool is None:
+            return None
+        return self.pool.getStats()
+
+    def fetch(self, sql: str, params=None):
+        """Fetch records using the specified SQL and optional bound parameters."""
         self.log.debug('Fetching with SQL: %s', sql)
         if self.conn is None:
             self.log.error('Failed to fetch: not connected to database!')
             return None
         with self.conn.cursor() as cursor:
-            cursor.execute(sql)
+            cursor.execute(sql, params)
             rows = cursor.fetchall()
             self.log.info('Fetched %d records', len(rows))
             return rows
         
-    def execute(self, sql: str):
-        """Insert or update using the specified SQL. Return last inserted idx."""
+    def execute(self, sql: str, params=None):
+        """Insert or update using the specified SQL and optional bound parameters. 
+        Return last inserted idx."""
         self.log.info('Executing SQL: %s', sql)
         idx = None
         if self.conn is None:
             self.log.error('Failed to execute: not connected to database!')
             return
         with self.conn.cursor() as cursor:
-            cursor.execute(sql)
-            self.conn.commit()
+            cursor.execute(sql, params)
+            if self.nTransaction == 0:
+                self.conn.commit()
             idx = cursor.lastrowid
         return idx
+
+    def executeMany(self, sql: str, rows: list[tuple], chunkSize=500) -> list[int]:
+        """Execute a parameterized statement for many rows, one round trip per chunk.
+        Inserts are sent as multi-row INSERT statements and committed together.
+        Return the inserted idx of each row, or None on error. Inserts missing idx are an error
+        that rolls back the rows, or raises within a transaction."""
+        self.log.info('Executing SQL for %d rows: %s', len(rows), sql)
+        if self.conn is None:
+            self.log.error('Failed to execute: not connected to database!')
+            return None
+        ids = []
+        bInsert = sql.lstrip().lower().startswith('insert')
+        with self.conn.cursor() as cursor:
+            if self.nTransaction == 0:
+                self.conn.start_transaction()
+            try:
+                for iStart in range(0, len(rows), chunkSize):
+                    chunk = rows[iStart:iStart+chunkSize]
+                    cursor.executemany(sql, chunk)
+                    # A single multi-row insert gets consecutive auto-increment values
+                    if cursor.lastrowid:
+                        ids.extend(range(cursor.lastrowid, cursor.lastrowid + len(chunk)))
+                if bInsert and len(ids) != len(rows):
+                    raise Error(msg=f'Got {len(ids)} idx for {len(rows)} rows')
+                if self.nTransaction == 0:
+                    self.conn.commit()
+            except Error as e:
+                self.log.error('Failed to execute many: %s', e)
+                if self.nTransaction == 0:
+                    self.conn.rollback()
+                    return None
+                raise
+        return ids
         
 class Query():
-    """Class for building an SQL query."""
+    """Class for building an SQL query.
+    In bind mode, values are added as %s placeholders and collected 
+    in a parameter list, to be sent with the SQL by Database.execute."""
     log = logging.getLogger("Query")
 
-    def __init__(self, name: str):
+    def __init__(self, name: str, bindParams=False):
         """Constructor."""
         self.sio = io.StringIO()
         self.name = name
+        self.params = [] if bindParams else None
 
     def add(self, sql: str):
         """Add some SQL."""
-        if len(self.sio.getvalue()) > 0 and sql != ',':
+        if self.sio.tell() > 0 and sql != ',':
             self.sio.write(' ')
         self.sio.write(sql.strip())
         return self
 
+    def addParam(self, value):
+        """Add a bound parameter placeholder and its value. Only in bind mode."""
+        if self.params is None:
+            raise ValueError(f'{self} is not in bind mode')
+        self.params.append(value)
+        self.add('%s')
+        return self
+
+    def isBindMode(self) -> bool:
+        """Check if this query binds parameters."""
+        return self.params is not None
+
     def addEscapedString(self, text: str):
         """Escape quotes and add the text with quotes."""
         if text is None or text == '':
-            self.add('null')
+            self.addNull()
+        elif self.isBindMode():
+            self.addParam(text)
         else:
             escaped = text.replace("'", "''")
             self.add(f"'{escaped}'")
@@ -95,7 +294,9 @@ class Query():
     def addDate(self, dAt: datetime):
         """Add a datetime in database format."""
         if dAt is None:
-            self.add('null')
+            self.addNull()
+        elif self.isBindMode():
+            self.addParam(dAt)
         else:
             self.add(f"'{DateTools.datetimeToString(dAt, '%Y-%m-%d %H:%M:%S')}'")
         return self
@@ -103,7 +304,9 @@ class Query():
     def addBool(self, bValue: bool):
         """Add a bool value in database format."""
         if bValue is None:
-            self.add('null')
+            self.addNull()
+        elif self.isBindMode():
+            self.addParam(1 if bValue else 0)
         else:
             self.add('1' if bValue else '0')
         return self
@@ -111,11 +314,28 @@ class Query():
     def addNullableFK(self, fk: int):
         """Add the specified foreign key, or null if negative or None."""
         if fk is None or fk <= 0:
-            self.add('null')
+            self.addNull()
+        elif self.isBindMode():
+            self.addParam(fk)
         else:
             self.add(f'{fk}')
         return self
 
+    def addNull(self):
+        """Add a null value. Bound as a parameter in bind mode,
+        so that all rows of a batch share the same SQL."""
+        if self.isBindMode():
+            self.addParam(None)
+        else:
+            self.add('null')
+        return self
+
+    def getParams(self) -> tuple:
+        """Return the bound parameters, or None if not in bind mode."""
+        if self.params is None:
+            return None
+        return tuple(self.params)
+
     def getSQL(self):
         """Return the accumulated SQL"""
         return self.sio.getvalue()
@@ -139,6 +359,67 @@ def testDatabase():
     for row in rows:
         print(row)
     db.disconnect()
+    db.log.info('Pool stats: %s', db.getPoolStats())
+
+def testConnectionPool():
+    """Performance test comparing pooled and unpooled connections."""
+    dbname = 'herbier'
+    db = Database(dbname)
+    user = 'nicz'
+    pwd = getpass(f'Password for {user}@{dbname}:')
+    nQueries = 200
+    timer = Timer()
+    for i in range(nQueries):
+        conn = connect(host=db.host, user=user, password=pwd, database=dbname)
+        conn.close()
+    db.log.info(f'{nQueries} unpooled connections in {timer.getElapsed()}')
+    timer = Timer()
+    for i in range(nQueries):
+        db.connect(user, pwd)
+        db.disconnect()
+    db.log.info(f'{nQueries} pooled connections in {timer.getElapsed()}')
+    db.log.info('Pool stats: %s', db.getPoolStats())
+
+def testBulkInsert():
+    """Performance test comparing row-by-row and batched inserts."""
+    dbname = 'herbier'
+    db = Database(dbname)
+    user = 'nicz'
+    pwd = getpass(f'Password for {user}@{dbname}:')
+    nRows = 1000
+    db.connect(user, pwd)
+    db.execute('create table BenchBulk (idxBench int auto_increment primary key, '
+               'bnName varchar(128), bnAt datetime, bnFlag tinyint)')
+    try:
+        timer = Timer()
+        for i in range(nRows):
+            query = Query('BenchBulk')
+            query.add('insert into BenchBulk (idxBench, bnName, bnAt, bnFlag) values (null')
+            query.add(',').addEscapedString(f"row'{i}")
+            query.add(',').addDate(DateTools.nowDatetime())
+            query.add(',').addBool(i % 2 == 0)
+            query.add(')')
+            db.execute(query.getSQL())
+            query.close()
+        db.log.info(f'{nRows} row-by-row inserts in {timer.getElapsed()}')
+        timer = Timer()
+        sql = None
+        rows = []
+        for i in range(nRows):
+            query = Query('BenchBulk', True)
+            query.add('insert into BenchBulk (idxBench, bnName, bnAt, bnFlag) values (null')
+            query.add(',').addEscapedString(f"row'{i}")
+            query.add(',').addDate(DateTools.nowDatetime())
+            query.add(',').addBool(i % 2 == 0)
+            query.add(')')
+            sql = query.getSQL()
+            rows.append(query.getParams())
+            query.close()
+        ids = db.executeMany(sql, rows)
+        db.log.info(f'{nRows} batched inserts in {timer.getElapsed()}, ids {ids[0]}..{ids[-1]}')
+    finally:
+        db.execute('drop table BenchBulk')
+        db.disconnect()
 
 def testQuery():
     """Unit test for Query"""
@@ -150,9 +431,17 @@ def testQuery():
     obj.log.info(obj)
     obj.log.info(obj.getSQL())
     obj.close() 
+    obj = Query("SomeTable", True)
+    obj.add('insert into Bleu values (null')
+    obj.add(',').addEscapedString("l'eau").add(',').addNullableFK(-1)
+    obj.add(',').addBool(True).add(')')
+    obj.log.info('%s %s', obj.getSQL(), obj.getParams())
+    obj.close()
 
 if __name__ == '__main__':
     logging.basicConfig(format="%(levelname)s %(name)s: %(message)s", 
         level=logging.INFO, handlers=[logging.StreamHandler()])
     testDatabase()
+    testConnectionPool()
+    testBulkInsert()
     testQuery()
\ No newline at end of file
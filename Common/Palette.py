@@ -16,25 +16,84 @@ import numpy as np
 from HtmlPage import *
 
 class Palette:
-    """A color gradient rendered using gaussian distributions"""
+    """A color gradient rendered using gaussian distributions.
+    Arrays of values are colored with getColors, using a lookup table of iLutSize
+    colors sampled from getColor. With the default 4096 entries, the colors differ
+    from getColor by at most 1 per channel for the gaussian palettes with sigma >= 0.1,
+    by 2 for LinesPalette, and CombPalette only differs within half a step of its edges."""
     log = logging.getLogger('Palette')
     sigma = 0.35
+    iLutSize = 4096
+    nWideLuts = 8
+    invalidColor = (0, 0, 0)
 
     def __init__(self, sName):
         """Constructor with palette name."""
         self.sName = sName
+        self.aLut = None
+        self.dWideLuts = {}
 
     def toColorScale(self, sFilename, iWidth, iHeight):
         """Save a color scale PNG of this palette with the specified size."""
         self.log.info('Saving %s to %ix%i color scale as %s', self.sName, iWidth, iHeight, sFilename)
-        rgbArray = np.zeros((iHeight, iWidth, 3), 'uint8')
-        for x in range(iWidth):
-            col = self.getColor(x/iWidth)
-            for y in range(iHeight):
-                rgbArray[y, x, :] = col
+        aColors = self.getColors(np.arange(iWidth)/iWidth)
+        rgbArray = np.repeat(aColors[np.newaxis, :, :], iHeight, axis=0)
         img = Image.fromarray(rgbArray)
         img.save(sFilename, 'PNG')
 
+    def setLutSize(self, iLutSize: int):
+        """Set the number of colors of the lookup table, which is built again on next use."""
+        self.iLutSize = iLutSize
+        self.aLut = None
+        self.dWideLuts = {}
+
+    def makeLut(self, rMin: float, rMax: float, iSize: int) -> np.ndarray:
+        """Sample getColor on iSize values from rMin to rMax into an array of RGB colors."""
+        aColors = [np.broadcast_to(self.getColor(x), (3,)) for x in np.linspace(rMin, rMax, iSize)]
+        return np.clip(np.array(aColors), 0, 255).astype(np.uint8)
+
+    def getLut(self) -> np.ndarray:
+        """Get the lookup table of colors for values from 0 to 1, built on first use
+        as the subclasses set their parameters after this constructor."""
+        if self.aLut is None or len(self.aLut) != self.iLutSize:
+            self.aLut = self.makeLut(0.0, 1.0, self.iLutSize)
+        return self.aLut
+
+    def getWideLut(self, rMin: float, rMax: float) -> np.ndarray:
+        """Get a lookup table from rMin to rMax with the resolution of the 0 to 1 table, up to 100 times larger.
+        The last nWideLuts tables are kept by (rMin, rMax, size)."""
+        iSize = min(int(np.ceil((rMax - rMin)*(self.iLutSize - 1))) + 1, 100*self.iLutSize)
+        key = (rMin, rMax, iSize)
+        aLut = self.dWideLuts.pop(key, None)
+        if aLut is None:
+            self.log.debug('Building %s table of %d colors from %g to %g', self.sName, iSize, rMin, rMax)
+            aLut = self.makeLut(rMin, rMax, iSize)
+            while len(self.dWideLuts) >= self.nWideLuts:
+                del self.dWideLuts[next(iter(self.dWideLuts))]
+        self.dWideLuts[key] = aLut
+        return aLut
+
+    def getColors(self, aValues: np.ndarray) -> np.ndarray:
+        """Get the RGB colors of an array of values as a uint8 array of shape aValues.shape + (3,).
+        Values outside 0 to 1 are colored with a wider table from the integers around them,
+        so that similar ranges share it. NaN and infinite values get invalidColor."""
+        aValues = np.asarray(aValues, dtype=float)
+        aFinite = np.isfinite(aValues)
+        bAllFinite = aFinite.all()
+        aValid = aValues if bAllFinite else aValues[aFinite]
+        (rMin, rMax) = (min(0.0, np.floor(np.amin(aValid))), max(1.0, np.ceil(np.amax(aValid)))) if aValid.size else (0.0, 1.0)
+        if rMin == 0.0 and rMax == 1.0:
+            aLut = self.getLut()
+        else:
+            aLut = self.getWideLut(float(rMin), float(rMax))
+        rScale = (len(aLut) - 1)/(rMax - rMin)
+        if bAllFinite:
+            return aLut[np.rint((aValues - rMin)*rScale).astype(np.intp)]
+        aColors = np.empty(aValues.shape + (3,), dtype=np.uint8)
+        aColors[...] = self.invalidColor
+        aColors[aFinite] = aLut[np.rint((aValid - rMin)*rScale).astype(np.intp)]
+        return aColors
+
     def getColor(self, x):
         """Get the RGB color array for the specified value between 0 and 1."""
         return [Palette.gauss(x, 0.75, self.sigma), Palette.gauss(x, 0.5, self.sigma), Palette.gauss(x, 0.25, self.sigma)]
@@ -191,6 +250,35 @@ class GrayScalePalette(Palette):
         return max(0, min(255, (int)(255. * x)))
 
 
+def benchPaletteLut():
+    """Measure the largest color difference between getColors and getColor, and time both."""
+    import time
+    aPalettes = [RandomPalette(), SimplePalette('SimplePalette', 0.3, 0.7, 0.5, 0.2), HeatPalette(),
+                 DarkHeatPalette(), LinesPalette(), CombPalette(), FractalPalette(), GrayScalePalette()]
+    aValues = np.random.default_rng(1).random((500, 500))
+    for oPal in aPalettes:
+        tStart = time.time()
+        aExact = np.array([[np.broadcast_to(oPal.getColor(x), (3,)) for x in aRow] for aRow in aValues])
+        secExact = time.time() - tStart
+        tStart = time.time()
+        aColors = oPal.getColors(aValues)
+        secLut = time.time() - tStart
+        aDiff = np.abs(aColors.astype(int) - aExact)
+        print(f'{oPal.sName}: getColor {secExact:.3f}s, getColors {secLut:.3f}s, max error {aDiff.max()}, '
+              f'{100*np.mean(aDiff.max(axis=2) > 1):.2f}% of pixels above 1')
+    # 500x500 HeatPalette: getColor 2.237s, getColors 0.062s building the table, then 0.007s
+    oPal = HeatPalette()
+    aWide = aValues*2.6 - 0.8
+    aWide[0, :10] = [np.nan, np.inf, -np.inf] + [0.5]*7
+    for i in range(3):
+        tStart = time.time()
+        aColors = oPal.getColors(aWide*(1 + 0.01*i))
+        aFinite = aWide[np.isfinite(aWide)]
+        print(f'{oPal.sName} values {aFinite.min():.2f} to {aFinite.max():.2f} '
+              f'with NaN: {time.time() - tStart:.3f}s, invalid colors {aColors[0, :3].tolist()}, '
+              f'{len(oPal.dWideLuts)} wide table(s)')
+    # 500x500 -0.80 to 1.80 with NaN: 0.131s building the table from -1 to 2, then 0.019s
+
 def demoPalette():
     """Palette demo. Create a HTML page with palette renderings."""
     aPalettes = [HeatPalette(),
@@ -225,4 +313,5 @@ def demoPalette():
 if __name__ == '__main__':
     logging.basicConfig(format="[%(levelname)s] %(message)s", 
         level=logging.DEBUG, handlers=[logging.StreamHandler()])
-    demoPalette()
\ No newline at end of file
+    demoPalette()
+    benchPaletteLut()
\ No newline at end of file
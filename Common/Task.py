@@ -18,6 +18,7 @@ class Task:
         self.nStepsTotal = nStepsTotal
         self.nStepsDone = 0
         self.status = 'Idle'
+        self.bCancelled = False
         self.log.info('Constructor %s', self)
 
     def load(self):
@@ -42,6 +43,14 @@ class Task:
     def getStatus(self) -> str:
         return f'{self.status} [{self.nStepsDone}/{self.nStepsTotal}]'
 
+    def cancel(self):
+        """Ask this task to stop, possibly from another thread."""
+        self.bCancelled = True
+
+    def isCancelled(self) -> bool:
+        """Check if this task was asked to stop."""
+        return self.bCancelled
+
     def isOver(self):
         """Check if this task is done."""
         return self.nStepsDone >= self.nStepsTotal
@@ -0,0 +1,175 @@
+"""
+ Render a fractal view as tiles on a pool of worker processes,
+ in a Tk app or headless.
+"""
+
+__author__ = "Nicolas Zwahlen"
+__copyright__ = "Copyright 2023 N. Zwahlen"
+__version__ = "1.0.0"
+
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from PIL import Image
+from FractalSet import FractalSet
+from Palette import Palette
+
+
+def renderTile(oFractal: FractalSet, center: complex, width: float, iSize: int, iX, iY, iW, iH):
+    """Compute the iterations of a tile of the view. Module function so that it can run in a worker process."""
+    return (iX, iY, oFractal.iterTile(center, width, iSize, iX, iY, iW, iH))
+
+
+def getIterationColors(oPalette: Palette, iMaxIter: int, iPeriod: int = None) -> np.ndarray:
+    """Get the RGB color of each iteration count from 0 to iMaxIter, to color iterations by indexing.
+    With a period, the palette repeats every iPeriod iterations, and iMaxIter keeps the last color."""
+    aValues = [(i % iPeriod)/iPeriod if iPeriod else i/iMaxIter for i in range(iMaxIter)] + [1.0]
+    aColors = np.array([oPalette.getColor(x) for x in aValues])
+    return np.clip(aColors, 0, 255).astype(np.uint8)
+
+
+class FractalRenderer:
+    """Renders a square view of a fractal by tiles on a shared process pool.
+    The tiles are computed from the center of the view outwards and can be
+    collected as they complete, so the image is shown progressively."""
+    log = logging.getLogger('FractalRenderer')
+    nWorkers = os.cpu_count()
+    iTileSize = 64
+    _executor = None
+
+    def __init__(self, oFractal: FractalSet, center: complex, width: float, iSize: int):
+        self.oFractal = oFractal
+        self.center = center
+        self.width = width
+        self.iSize = iSize
+        self.aIter = np.full((iSize, iSize), oFractal.iMaxIter, dtype=np.int32)
+        self.futures = []
+        self.pending = set()
+        self.nPixels = 0
+        self.tStart = 0.0
+        self.tEnd = None
+        self.bCancelled = False
+
+    @classmethod
+    def getExecutor(cls) -> ProcessPoolExecutor:
+        """Get the process pool shared by all renders, creating it on first use."""
+        if cls._executor is None:
+            cls.log.info('Starting %d render processes', cls.nWorkers)
+            cls._executor = ProcessPoolExecutor(max_workers=cls.nWorkers)
+        return cls._executor
+
+    @classmethod
+    def shutdown(cls):
+        """Stop the process pool."""
+        if cls._executor is not None:
+            cls._executor.shutdown(cancel_futures=True)
+            cls._executor = None
+
+    def getTiles(self) -> list[tuple[int, int, int, int]]:
+        """Get the (x, y, width, height) tiles of the view, closest to the center first."""
+        aTiles = []
+        for iY in range(0, self.iSize, self.iTileSize):
+            for iX in range(0, self.iSize, self.iTileSize):
+                aTiles.append((iX, iY, min(self.iTileSize, self.iSize - iX), min(self.iTileSize, self.iSize - iY)))
+        half = self.iSize/2
+        return sorted(aTiles, key=lambda t: (t[0] + t[2]/2 - half)**2 + (t[1] + t[3]/2 - half)**2)
+
+    def start(self):
+        """Prepare the fractal for the view and submit all tiles to the process pool."""
+        self.tStart = time.time()
+        self.oFractal.prepare(self.center, self.width)
+        self.aIter = np.full((self.iSize, self.iSize), self.oFractal.iMaxIter, dtype=np.int32)
+        executor = self.getExecutor()
+        self.futures = [executor.submit(renderTile, self.oFractal, self.center, self.width, self.iSize, *tile)
+                        for tile in self.getTiles()]
+        self.pending = set(self.futures)
+        self.log.info('Rendering %s at %s width %g in %d tiles', self.oFractal, self.center, self.width, len(self.futures))
+
+    def addTile(self, future) -> tuple[int, int, np.ndarray]:
+        """Copy a computed tile into the iteration buffer."""
+        (iX, iY, aTile) = future.result()
+        (iH, iW) = aTile.shape
+        self.aIter[iY:iY + iH, iX:iX + iW] = aTile
+        self.nPixels += aTile.size
+        self.pending.discard(future)
+        if not self.pending:
+            self.tEnd = time.time()
+            self.log.info('Rendered %d pixels in %.3fs, %.0f pixels/s',
+                          self.nPixels, self.getElapsedSeconds(), self.getPixelsPerSecond())
+        return (iX, iY, aTile)
+
+    def getFinishedTiles(self) -> list[tuple[int, int, np.ndarray]]:
+        """Get the (x, y, iterations) tiles completed since the last call, without waiting."""
+        if self.bCancelled:
+            return []
+        return [self.addTile(future) for future in self.futures if future in self.pending and future.done()]
+
+    def iterTiles(self):
+        """Yield the (x, y, iterations) tiles as they complete, waiting for them."""
+        for future in as_completed(self.futures):
+            if self.bCancelled:
+                return
+            yield self.addTile(future)
+
+    def render(self) -> np.ndarray:
+        """Render the whole view and return its iterations."""
+        self.start()
+        for _ in self.iterTiles():
+            pass
+        return self.aIter
+
+    def cancel(self):
+        """Cancel the tiles that did not start. The running ones complete but are ignored."""
+        if self.isDone():
+            return
+        self.bCancelled = True
+        nCancelled = sum(future.cancel() for future in self.pending)
+        self.tEnd = time.time()
+        self.log.info('Cancelled render with %d tiles left, %d not started', len(self.pending), nCancelled)
+
+    def isDone(self) -> bool:
+        """Check if all tiles were collected or the render was cancelled."""
+        return self.bCancelled or (len(self.futures) > 0 and not self.pending)
+
+    def getElapsedSeconds(self) -> float:
+        return (self.tEnd or time.time()) - self.tStart
+
+    def getPixelsPerSecond(self) -> float:
+        """Get the rendering throughput so far."""
+        seconds = self.getElapsedSeconds()
+        return self.nPixels/seconds if seconds > 0 else 0.0
+
+    def toImage(self, oPalette: Palette) -> Image.Image:
+        """Color the iterations with a palette, one color per iteration count."""
+        aColors = getIterationColors(oPalette, self.oFractal.iMaxIter, self.oFractal.iColorPeriod)
+        return Image.fromarray(aColors[self.aIter])
+
+    def save(self, sFilename: str, oPalette: Palette):
+        """Save the rendered view as a PNG image."""
+        self.log.info('Saving %s', sFilename)
+        self.toImage(oPalette).save(sFilename, 'PNG')
+
+
+def testFractalRenderer():
+    """Compare the tiled render on the process pool with a single iterGrid call."""
+    from FractalSet import MandelbrotSet, SineFractal
+    for oFractal in [MandelbrotSet(200), SineFractal(200)]:
+        for iSize in [600, 1200]:
+            center = oFractal.getDefaultCenter()
+            width = oFractal.getDefaultWidth()
+            tStart = time.time()
+            aIter = oFractal.iterGrid(oFractal.makeGrid(center, width, iSize))
+            seconds = time.time() - tStart
+            renderer = FractalRenderer(oFractal, center, width, iSize)
+            renderer.render()
+            sSame = 'same' if np.array_equal(aIter, renderer.aIter) else 'DIFFERENT'
+            print(f'{oFractal.sName} {iSize}x{iSize}: one process {iSize*iSize/seconds:.0f} pixels/s, '
+                  f'{FractalRenderer.nWorkers} processes {renderer.getPixelsPerSecond():.0f} pixels/s, {sSame}')
+    FractalRenderer.shutdown()
+
+if __name__ == '__main__':
+    logging.basicConfig(format="%(levelname)s %(name)s: %(message)s",
+        level=logging.INFO, handlers=[logging.StreamHandler()])
+    testFractalRenderer()
@@ -9,10 +9,16 @@ __version__ = "1.0.0"
 
 import logging
 import cmath
+import math
+import time
+from decimal import Decimal, localcontext
+import numpy as np
 
 class FractalSet:
     """A fractal set interface."""
     log = logging.getLogger('FractalSet')
+    bDeep = False
+    iColorPeriod = None
 
     def __init__(self, sName, iMaxIter, rBailout = 2.0):
         self.log.info('%s with %d iterations and %.1f bailout', sName, iMaxIter, rBailout)
@@ -23,6 +29,71 @@ class FractalSet:
     def iter(self, z):
         """Compute the iterations required to bailout at complex number z."""
         return self.iMaxIter
+
+    def iterGrid(self, aZ: np.ndarray) -> np.ndarray:
+        """Compute the iterations required to bailout at each complex number of an array."""
+        return np.full(aZ.shape, self.iMaxIter, dtype=np.int32)
+
+    def stepGrid(self, aZ: np.ndarray, aC):
+        """Compute one iteration for an array of complex numbers and their constants."""
+        return aZ
+
+    @staticmethod
+    def multiply(aA, aB) -> np.ndarray:
+        """Multiply complex arrays with the same rounding as Python complex numbers,
+        which the vectorized complex product of NumPy does not always have."""
+        aProduct = np.empty(np.broadcast(aA, aB).shape, dtype=complex)
+        aProduct.real = aA.real*aB.real - aA.imag*aB.imag
+        aProduct.imag = aA.real*aB.imag + aA.imag*aB.real
+        return aProduct
+
+    def escapeTime(self, aZ: np.ndarray, aC) -> np.ndarray:
+        """Iterate stepGrid on all the points at once, dropping the points that escaped,
+        and return their iteration counts, equal to those of iter. aC is an array like aZ or a scalar."""
+        aIter = np.full(aZ.shape, self.iMaxIter, dtype=np.int32)
+        aIdx = np.arange(aZ.size)
+        aZ = aZ.ravel()
+        if np.ndim(aC):
+            aC = np.ravel(aC)
+        with np.errstate(all='ignore'):
+            for i in range(self.iMaxIter):
+                if aIdx.size == 0:
+                    break
+                aZ = self.stepGrid(aZ, aC)
+                aEscaped = np.abs(aZ) > self.rBailout
+                if aEscaped.any():
+                    aIter.flat[aIdx[aEscaped]] = i
+                    aKeep = ~aEscaped
+                    aIdx = aIdx[aKeep]
+                    aZ = aZ[aKeep]
+                    if np.ndim(aC):
+                        aC = aC[aKeep]
+        return aIter
+
+    def prepare(self, center, width: float):
+        """Prepare the rendering of a view, before its tiles are computed. Nothing to do by default."""
+        pass
+
+    def iterTile(self, center, width: float, iSize: int, iX: int, iY: int, iW: int, iH: int) -> np.ndarray:
+        """Compute the iterations of a tile of a square view."""
+        return self.iterGrid(self.makeTile(center, width, iSize, iX, iY, iW, iH))
+
+    def getRenderInfo(self) -> str:
+        """Get details about the last rendering, for the status."""
+        return ''
+
+    def makeGrid(self, center: complex, width: float, iSize: int) -> np.ndarray:
+        """Get the complex numbers of the pixels of a square view, indexed [y, x] like an image."""
+        return self.makeTile(center, width, iSize, 0, 0, iSize, iSize)
+
+    def makeTile(self, center: complex, width: float, iSize: int, iX: int, iY: int, iW: int, iH: int) -> np.ndarray:
+        """Get the complex numbers of the pixels of a tile of a square view."""
+        dx = width/iSize
+        bl = center - complex(width/2.0, width/2.0)
+        aZ = np.empty((iH, iW), dtype=complex)
+        aZ.real = (bl.real + np.arange(iX, iX + iW)*dx)[np.newaxis, :]
+        aZ.imag = (bl.imag + np.arange(iY, iY + iH)*dx)[:, np.newaxis]
+        return aZ
     
     def getDefaultCenter(self) -> complex:
         return complex(0.0, 0.0)
@@ -49,11 +120,113 @@ class MandelbrotSet(FractalSet):
             if abs(z) > self.rBailout:
                 return i
         return self.iMaxIter
+
+    def iterGrid(self, aZ):
+        return self.escapeTime(aZ, aZ)
+
+    def stepGrid(self, aZ, aC):
+        return self.multiply(aZ, aZ) + aC
     
     def getDefaultCenter(self):
         return complex(-0.75, 0.0)
     
 
+class DeepMandelbrotSet(MandelbrotSet):
+    """The Mandelbrot set for deep zooms, by perturbation theory. The orbit of the view center
+    is computed once with Decimal numbers, and each pixel only iterates its difference to that
+    reference orbit in double precision. When the orbit of a pixel gets smaller than its
+    difference, which would lose precision, or when the reference orbit ends, the pixel is
+    rebased on the start of the reference orbit. Doubles limit zooms to widths above 1e-300.
+    The iterations grow with the zoom depth, and colors repeat every iBaseIter iterations.
+    The center of the view is a (Decimal real, Decimal imaginary) tuple."""
+    log = logging.getLogger('DeepMandelbrotSet')
+    bDeep = True
+    bAutoIter = True
+
+    def __init__(self, iMaxIter, rBailout = 2.0):
+        FractalSet.__init__(self, 'Mandelbrot deep zoom', iMaxIter, rBailout)
+        self.iBaseIter = iMaxIter
+        self.iColorPeriod = iMaxIter
+        self.aRef = np.zeros(1, dtype=complex)
+        self.nDigits = 0
+        self.secReference = 0.0
+        self.nRebases = 0
+
+    @staticmethod
+    def getDigits(width: float) -> int:
+        """Get the number of decimal digits needed for a view of that width."""
+        return max(20, int(-math.log10(width)) + 20)
+
+    @staticmethod
+    def toDeep(center) -> tuple[Decimal, Decimal]:
+        """Convert a complex center to a Decimal tuple, keeping a tuple as it is."""
+        if isinstance(center, tuple):
+            return center
+        return (Decimal(center.real), Decimal(center.imag))
+
+    @staticmethod
+    def moveCenter(center, dx: float, dy: float, width: float) -> tuple[Decimal, Decimal]:
+        """Move a Decimal center by an offset, with enough digits for the view width."""
+        (re, im) = DeepMandelbrotSet.toDeep(center)
+        with localcontext() as ctx:
+            ctx.prec = DeepMandelbrotSet.getDigits(width)
+            return (re + Decimal(dx), im + Decimal(dy))
+
+    def prepare(self, center, width: float):
+        """Compute the reference orbit of the view center, and more iterations for deeper zooms."""
+        tStart = time.time()
+        if self.bAutoIter:
+            self.iMaxIter = max(self.iBaseIter, int(self.iBaseIter*(1.0 + 0.25*math.log2(3.0/width))))
+        (cRe, cIm) = self.toDeep(center)
+        self.nDigits = self.getDigits(width)
+        rBailout2 = Decimal(self.rBailout*self.rBailout)
+        aRef = [complex(0.0, 0.0)]
+        with localcontext() as ctx:
+            ctx.prec = self.nDigits
+            (zRe, zIm) = (Decimal(0), Decimal(0))
+            for i in range(self.iMaxIter + 1):
+                (zRe, zIm) = (zRe*zRe - zIm*zIm + cRe, 2*zRe*zIm + cIm)
+                aRef.append(complex(float(zRe), float(zIm)))
+                if zRe*zRe + zIm*zIm > rBailout2:
+                    break
+        self.aRef = np.array(aRef)
+        self.secReference = time.time() - tStart
+        self.log.info('Reference orbit of %d iterations with %d digits in %.3fs for %d max iterations',
+                      len(self.aRef) - 1, self.nDigits, self.secReference, self.iMaxIter)
+
+    def iterTile(self, center, width, iSize, iX, iY, iW, iH):
+        """Iterate the differences of the pixels of a tile to the reference orbit."""
+        aDc = self.makeTile(0j, width, iSize, iX, iY, iW, iH).ravel()
+        aIter = np.full(aDc.size, self.iMaxIter, dtype=np.int32)
+        aIdx = np.arange(aDc.size)
+        aD = aDc.copy()
+        aM = np.ones(aDc.size, dtype=np.intp)
+        iLast = len(self.aRef) - 1
+        self.nRebases = 0
+        with np.errstate(all='ignore'):
+            for i in range(self.iMaxIter):
+                if aIdx.size == 0:
+                    break
+                aD = 2.0*self.aRef[aM]*aD + aD*aD + aDc
+                aM += 1
+                aZ = self.aRef[aM] + aD
+                aAbs = np.abs(aZ)
+                aEscaped = aAbs > self.rBailout
+                if aEscaped.any():
+                    aIter[aIdx[aEscaped]] = i
+                    aKeep = ~aEscaped
+                    (aIdx, aD, aDc, aM, aZ, aAbs) = (aIdx[aKeep], aD[aKeep], aDc[aKeep], aM[aKeep], aZ[aKeep], aAbs[aKeep])
+                aRebase = (aAbs < np.abs(aD)) | (aM == iLast)
+                if aRebase.any():
+                    aD[aRebase] = aZ[aRebase]
+                    aM[aRebase] = 0
+                    self.nRebases += np.count_nonzero(aRebase)
+        return aIter.reshape((iH, iW))
+
+    def getRenderInfo(self) -> str:
+        return f'reference orbit {len(self.aRef) - 1} iterations, {self.nDigits} digits in {self.secReference:.3f}s'
+
+
 class JuliaSet(FractalSet):
     """The Julia set fractal."""
     log = logging.getLogger('JuliaSet')
@@ -69,6 +242,12 @@ class JuliaSet(FractalSet):
             if abs(z) > self.rBailout:
                 return i
         return self.iMaxIter
+
+    def iterGrid(self, aZ):
+        return self.escapeTime(aZ, self.c)
+
+    def stepGrid(self, aZ, aC):
+        return self.multiply(aZ, aZ) + aC
     
 
 class BurningShip(FractalSet):
@@ -87,6 +266,15 @@ class BurningShip(FractalSet):
             if abs(z) > self.rBailout:
                 return i
         return self.iMaxIter
+
+    def iterGrid(self, aZ):
+        return self.escapeTime(aZ, aZ)
+
+    def stepGrid(self, aZ, aC):
+        aAbs = np.empty_like(aZ)
+        aAbs.real = np.abs(aZ.real)
+        aAbs.imag = np.abs(aZ.imag)
+        return self.multiply(aAbs, aAbs) + aC
     
     def getDefaultCenter(self):
         return complex(0.0, -0.5)
@@ -111,6 +299,12 @@ class LogisticMap(FractalSet):
                 return i
         return self.iMaxIter
 
+    def iterGrid(self, aZ):
+        return self.escapeTime(aZ, aZ)
+
+    def stepGrid(self, aZ, aC):
+        return self.multiply(self.multiply(aC, aZ), 1.0 - aZ)
+
 
 class SineFractal(FractalSet):
     """Sine fractal."""
@@ -127,6 +321,12 @@ class SineFractal(FractalSet):
             if abs(z) > self.rBailout:
                 return i
         return self.iMaxIter
+
+    def iterGrid(self, aZ):
+        return self.escapeTime(aZ, aZ)
+
+    def stepGrid(self, aZ, aC):
+        return np.sin(aZ) + aC
     
     def getDefaultWidth(self) -> float:
         return 6.3
@@ -151,9 +351,79 @@ class DucksFractal(FractalSet):
         except:
             pass
         return self.iMaxIter
+
+    def iterGrid(self, aZ):
+        return self.escapeTime(aZ, complex(0.0001, 0.0001))
+
+    def stepGrid(self, aZ, aC):
+        aAbs = np.empty_like(aZ)
+        aAbs.real = aZ.real
+        aAbs.imag = np.abs(aZ.imag)
+        return np.log(aAbs + aC)
     
     def getDefaultCenter(self):
         return complex(0.0, 0.0)
     
     def getDefaultWidth(self) -> float:
-        return 4.0
\ No newline at end of file
+        return 4.0
+
+
+def testIterGrid():
+    """Compare the iterations of iter and iterGrid for all fractals at several sizes, and time them."""
+    from Timer import Timer
+    aFractals = [MandelbrotSet(200), JuliaSet(200), BurningShip(200),
+                 LogisticMap(200), SineFractal(200), DucksFractal(200)]
+    for oFractal in aFractals:
+        for iSize in [64, 128, 256, 600]:
+            aZ = oFractal.makeGrid(oFractal.getDefaultCenter(), oFractal.getDefaultWidth(), iSize)
+            timer = Timer()
+            aIter = oFractal.iterGrid(aZ)
+            sGrid = timer.getElapsed()
+            sScalar = 'skipped'
+            sSame = ''
+            if iSize <= 256:
+                timer = Timer()
+                aScalar = np.array([[oFractal.iter(z) for z in aRow] for aRow in aZ])
+                sScalar = timer.getElapsed()
+                nDiff = np.count_nonzero(aScalar != aIter)
+                sSame = ', same' if nDiff == 0 else f', {nDiff} different'
+            print(f'{oFractal.sName} {iSize}x{iSize}: scalar {sScalar}, grid {sGrid}{sSame}')
+    # Mandelbrot 256x256: scalar 0.394s, grid 0.033s; 600x600 grid 0.184s
+    # Sine and Ducks 256x256: scalar 0.825s and 2.581s, grid 0.189s and 0.192s
+
+def testDeepZoom(sRe='-1.5436890126920764', sIm='0', iSize=100, nSamples=20):
+    """Zoom on a point with perturbation and with doubles, timing the reference orbit and the render,
+    and compare sampled pixels with iterations in Decimal numbers."""
+    center = (Decimal(sRe), Decimal(sIm))
+    oDeep = DeepMandelbrotSet(200)
+    aRandom = np.random.default_rng(1)
+    for width in [1e-6, 1e-10, 1e-14, 1e-20, 1e-30, 1e-50]:
+        tStart = time.time()
+        oDeep.prepare(center, width)
+        aIter = oDeep.iterTile(center, width, iSize, 0, 0, iSize, iSize)
+        secRender = time.time() - tStart
+        oDouble = MandelbrotSet(oDeep.iMaxIter)
+        aDouble = oDouble.iterGrid(oDouble.makeGrid(complex(float(center[0]), float(center[1])), width, iSize))
+        nWrong = 0
+        with localcontext() as ctx:
+            ctx.prec = oDeep.nDigits + 10
+            for (x, y) in aRandom.integers(0, iSize, (nSamples, 2)):
+                (cRe, cIm) = (center[0] + Decimal(-width/2 + x*(width/iSize)), center[1] + Decimal(-width/2 + y*(width/iSize)))
+                (zRe, zIm) = (cRe, cIm)
+                iExact = oDeep.iMaxIter
+                for i in range(oDeep.iMaxIter):
+                    (zRe, zIm) = (zRe*zRe - zIm*zIm + cRe, 2*zRe*zIm + cIm)
+                    if zRe*zRe + zIm*zIm > 4:
+                        iExact = i
+                        break
+                nWrong += iExact != aIter[y, x]
+        print(f'Width {width:g}: {oDeep.getRenderInfo()}, render {secRender:.3f}s with {oDeep.nRebases} rebases, '
+              f'{nWrong}/{nSamples} samples differ, {len(np.unique(aIter))} distinct values, {len(np.unique(aDouble))} with doubles')
+    # 100x100 at 1e-30: reference 5263 iterations with 50 digits in 0.014s, render 0.118s, no sample differs,
+    # 29 distinct values against 19 with doubles, which are blocks of identical pixels below about 1e-16
+
+if __name__ == '__main__':
+    logging.basicConfig(format="%(levelname)s %(name)s: %(message)s",
+        level=logging.INFO, handlers=[logging.StreamHandler()])
+    testIterGrid()
+    testDeepZoom()
@@ -10,8 +10,12 @@ import tkinter as tk
 from tkinter import ttk
 from tkinter.filedialog import asksaveasfile
 import logging
+import time
+import numpy as np
+from PIL import Image, ImageTk
 from BaseApp import *
 from FractalSet import *
+from FractalRenderer import FractalRenderer, getIterationColors
 from Palette import *
 from Timer import *
 
@@ -23,54 +27,91 @@ class FractalsApp(BaseApp):
     def __init__(self, sTitle, sGeometry = '1000x650') -> None:
         self.iSize = 600
         self.iMaxIter = 200
+        self.msPoll = 50
+        self.renderer = None
+        self.aRGB = np.full((self.iSize, self.iSize, 3), 0x10, dtype=np.uint8)
+        self.secDraw = 0.0
         self.aFractals = [MandelbrotSet(self.iMaxIter), 
                           JuliaSet(self.iMaxIter), 
                           BurningShip(self.iMaxIter), 
                           LogisticMap(self.iMaxIter),
                           SineFractal(self.iMaxIter),
-                          DucksFractal(self.iMaxIter)]
+                          DucksFractal(self.iMaxIter),
+                          DeepMandelbrotSet(self.iMaxIter)]
         self.oFractal = self.aFractals[0]
         self.aPalettes = [FractalPalette(), FluoPalette(),
                           HeatPalette(), DarkHeatPalette(), 
                           SepiaPalette(), GhostPalette()]
         self.oPalette = self.aPalettes[0]
         self.center = self.oFractal.getDefaultCenter()
+        self.deepCenter = DeepMandelbrotSet.toDeep(self.center)
         self.width  = self.oFractal.getDefaultWidth()
         super().__init__(sTitle, sGeometry)
         self.plotPalette()
 
     def plot(self):
-        """Compute the fractal and draw it live on the canvas."""
+        """Start computing the fractal on the render processes, cancelling any previous render.
+        The tiles are drawn on the canvas as they complete."""
+        self.cancelRender()
         self.setStatus('Plotting ' + self.oFractal.__str__())
         self.window.configure(cursor='watch')
-        self.window.update()
 
-        # Draw fractal on canvas live
-        self.oImgFract = tk.PhotoImage(width=self.iSize, height=self.iSize)
+        self.aRGB[:] = 0x10
+        self.secDraw = 0.0
+        self.oImgFract = ImageTk.PhotoImage(Image.fromarray(self.aRGB))
         self.canFractal.create_image(0, 0, anchor=tk.NW, image=self.oImgFract)
-        timer = Timer()
-        dx = self.width/self.iSize
-        bl = self.center - complex(self.width/2.0, self.width/2.0)
-        for x in range(self.iSize):
-            for y in range(self.iSize):
-                c = bl + complex(x*dx, y*dx)
-                iter = self.oFractal.iter(c)
-                sColor = self.oPalette.getColorHex(iter/self.iMaxIter)
-                self.oImgFract.put(sColor, (x, y))
-            if (x % 20 == 0):
-                self.window.update()
-
-        self.window.configure(cursor='')
-        self.setStatus('Plotted ' + self.oFractal.__str__() + ' in ' + timer.getElapsed())
+        center = self.deepCenter if self.oFractal.bDeep else self.center
+        self.renderer = FractalRenderer(self.oFractal, center, self.width, self.iSize)
+        self.renderer.start()
+        self.aColors = getIterationColors(self.oPalette, self.oFractal.iMaxIter, self.oFractal.iColorPeriod)
+        self.window.after(self.msPoll, self.pollRender, self.renderer)
+
+    def pollRender(self, renderer: FractalRenderer):
+        """Draw the finished tiles of a render, and poll again until it is done."""
+        if renderer is not self.renderer or renderer.bCancelled:
+            return
+        aTiles = renderer.getFinishedTiles()
+        if aTiles:
+            tStart = time.time()
+            for (iX, iY, aTile) in aTiles:
+                self.colorTile(iX, iY, aTile)
+            self.oImgFract.paste(Image.fromarray(self.aRGB))
+            self.secDraw += time.time() - tStart
+        if renderer.isDone():
+            self.window.configure(cursor='')
+            sStatus = (f'Plotted {self.oFractal} at width {self.width:.3g} in {renderer.getElapsedSeconds():.3f}s, '
+                       f'{renderer.getPixelsPerSecond():.0f} pixels/s, drawn in {1000*self.secDraw:.0f}ms')
+            if self.oFractal.getRenderInfo():
+                sStatus += ', ' + self.oFractal.getRenderInfo()
+            self.setStatus(sStatus)
+        else:
+            self.window.after(self.msPoll, self.pollRender, renderer)
+
+    def colorTile(self, iX: int, iY: int, aTile):
+        """Color a tile of iterations into the RGB buffer of the fractal image."""
+        (iH, iW) = aTile.shape
+        self.aRGB[iY:iY + iH, iX:iX + iW] = self.aColors[aTile]
+
+    def recolor(self):
+        """Color the whole fractal image again with the current palette, without computing it again."""
+        self.aColors = getIterationColors(self.oPalette, self.oFractal.iMaxIter, self.oFractal.iColorPeriod)
+        if self.renderer and self.renderer.isDone() and not self.renderer.bCancelled:
+            self.aRGB[:] = self.aColors[self.renderer.aIter]
+            self.oImgFract.paste(Image.fromarray(self.aRGB))
+
+    def cancelRender(self):
+        """Cancel the render in progress, if any."""
+        if self.renderer and not self.renderer.isDone():
+            self.renderer.cancel()
+            self.window.configure(cursor='')
+            self.setStatus(f'Cancelled {self.oFractal} after {self.renderer.nPixels} pixels')
 
     def plotPalette(self):
         """Draw palette color scale on canvas"""
         self.log.info('Plotting %s', self.oPalette.__str__())
-        self.oImgPal = tk.PhotoImage(width=50, height=self.iSize)
-        for x in range(50):
-            for y in range(self.iSize):
-                sColor = self.oPalette.getColorHex(y/self.iSize)
-                self.oImgPal.put(sColor, (x, y))
+        aColors = self.oPalette.getColors(np.arange(self.iSize)/self.iSize)
+        aScale = np.repeat(aColors[:, np.newaxis, :], 50, axis=1)
+        self.oImgPal = ImageTk.PhotoImage(Image.fromarray(aScale))
         self.canPalette.create_image(0, 0, anchor=tk.NW, image=self.oImgPal)
         self.window.update()
     
@@ -81,7 +122,9 @@ class FractalsApp(BaseApp):
         at = bl + complex(event.x*self.width/self.iSize, event.y*self.width/self.iSize)
         self.log.info('Canvas clicked at %s', at.__str__())
         self.lblCoords.configure(text=at.__str__())
-        self.center = at
+        self.deepCenter = DeepMandelbrotSet.moveCenter(self.deepCenter, event.x*self.width/self.iSize - self.width/2.0,
+                                                       event.y*self.width/self.iSize - self.width/2.0, self.width)
+        self.center = complex(float(self.deepCenter[0]), float(self.deepCenter[1]))
         self.width = 0.25*self.width
         self.plot()
 
@@ -109,18 +152,25 @@ class FractalsApp(BaseApp):
             sFilename = oFile.name
             self.setStatus('Saving image as ' + sFilename)
             oFile.close()
-            self.oImgFract.write(sFilename, 'PNG')
+            Image.fromarray(self.aRGB).save(sFilename, 'PNG')
         
+    def onBeforeClose(self):
+        """Cancel the render and stop the render processes."""
+        self.cancelRender()
+        FractalRenderer.shutdown()
+
     def reset(self):
         """Reset the current fractal to its default center and width."""
         self.setStatus('Resetting ' + self.oFractal.__str__())
         self.center = self.oFractal.getDefaultCenter()
+        self.deepCenter = DeepMandelbrotSet.toDeep(self.center)
         self.width  = self.oFractal.getDefaultWidth()
         self.plot()
 
     def createWidgets(self):
         """Create user widgets"""
         self.addButton('Plot', self.plot)
+        self.addButton('Stop', self.cancelRender)
         self.addButton('Zoom out', self.onZoomOut)
         self.addButton('Reset', self.reset)
         self.addButton('Save image', self.onSaveImage)
@@ -160,6 +210,7 @@ class FractalsApp(BaseApp):
             if oPalette.sName == sName:
                 self.oPalette = oPalette
                 self.plotPalette()
+                self.recolor()
                 break
 
     def addFractalSelector(self):
@@ -187,3 +238,32 @@ class FractalsApp(BaseApp):
         cboPalette.current(0)
         cboPalette.bind('<<ComboboxSelected>>', self.onPaletteSelect)
         cboPalette.pack(fill=tk.X, padx=4, pady=2)
+
+
+def testFrameTime():
+    """Time drawing an iteration buffer on a Tk image, per pixel and in bulk. Requires a display."""
+    window = tk.Tk()
+    window.withdraw()
+    oFractal = MandelbrotSet(200)
+    oPalette = FractalPalette()
+    for iSize in [300, 600, 1000]:
+        aIter = oFractal.iterGrid(oFractal.makeGrid(oFractal.getDefaultCenter(), oFractal.getDefaultWidth(), iSize))
+        tStart = time.time()
+        oImg = tk.PhotoImage(width=iSize, height=iSize)
+        for x in range(iSize):
+            for y in range(iSize):
+                oImg.put(oPalette.getColorHex(aIter[y, x]/oFractal.iMaxIter), (x, y))
+        window.update()
+        secPixels = time.time() - tStart
+        tStart = time.time()
+        oImg = ImageTk.PhotoImage(Image.fromarray(getIterationColors(oPalette, oFractal.iMaxIter)[aIter]))
+        window.update()
+        secBulk = time.time() - tStart
+        print(f'{iSize}x{iSize}: per pixel {1000*secPixels:.0f}ms, bulk {1000*secBulk:.1f}ms')
+    # Coloring only, without the Tk calls: 600x600 1392ms per pixel, 9.8ms in bulk; 1000x1000 3975ms, 25.5ms
+    window.destroy()
+
+if __name__ == '__main__':
+    logging.basicConfig(format="%(levelname)s %(name)s: %(message)s",
+        level=logging.INFO, handlers=[logging.StreamHandler()])
+    testFrameTime()
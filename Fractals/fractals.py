@@ -13,6 +13,7 @@ import os
 import sys
 import logging
 import getopt
+from decimal import Decimal
 from FractalsApp import *
 
 sAppName = 'Fractals'
@@ -33,13 +34,78 @@ def configureLogging():
     return logging.getLogger(sAppName)
 
 
+def getOptions():
+    """Parse program arguments and store them in a dict."""
+    dOptions = {'output': None, 'fractal': 'MandelbrotSet', 'palette': 'FractalPalette', 'center': None,
+                'width': None, 'size': 600, 'iter': 200, 'frames': 1, 'zoom': 4.0, 'workers': None}
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "ho:f:p:c:w:s:i:n:z:j:",
+            ["help", "output=", "fractal=", "palette=", "center=", "width=", "size=", "iter=", "frames=", "zoom=", "workers="])
+    except getopt.GetoptError:
+        print("Invalid options: %s", sys.argv[1:])
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            print('fractals.py without options opens the app, or renders headless with: -o (output PNG prefix) '
+                  '-f (fractal class) -p (palette class) -c (center re,im) -w (width) -s (size in pixels) '
+                  '-i (max iterations) -n (frames) -z (zoom per frame) -j (worker processes)')
+            sys.exit()
+        elif opt in ("-o", "--output"):
+            dOptions['output'] = arg
+        elif opt in ("-f", "--fractal"):
+            dOptions['fractal'] = arg
+        elif opt in ("-p", "--palette"):
+            dOptions['palette'] = arg
+        elif opt in ("-c", "--center"):
+            dOptions['center'] = tuple(arg.split(','))
+        elif opt in ("-w", "--width"):
+            dOptions['width'] = float(arg)
+        elif opt in ("-s", "--size"):
+            dOptions['size'] = int(arg)
+        elif opt in ("-i", "--iter"):
+            dOptions['iter'] = int(arg)
+        elif opt in ("-n", "--frames"):
+            dOptions['frames'] = int(arg)
+        elif opt in ("-z", "--zoom"):
+            dOptions['zoom'] = float(arg)
+        elif opt in ("-j", "--workers"):
+            dOptions['workers'] = int(arg)
+    return dOptions
+
+def renderBatch():
+    """Render frames zooming in on the center, and save them as numbered PNG files."""
+    dFractals = {cls.__name__: cls for cls in [MandelbrotSet, JuliaSet, BurningShip, LogisticMap, SineFractal,
+                                               DucksFractal, DeepMandelbrotSet]}
+    dPalettes = {cls.__name__: cls for cls in [FractalPalette, FluoPalette, HeatPalette, DarkHeatPalette, SepiaPalette, GhostPalette]}
+    oFractal = dFractals[dOptions['fractal']](dOptions['iter'])
+    oPalette = dPalettes[dOptions['palette']]()
+    center = oFractal.getDefaultCenter()
+    if dOptions['center'] is not None:
+        (sRe, sIm) = dOptions['center']
+        center = (Decimal(sRe), Decimal(sIm)) if oFractal.bDeep else complex(float(sRe), float(sIm))
+    width = dOptions['width'] or oFractal.getDefaultWidth()
+    if dOptions['workers']:
+        FractalRenderer.nWorkers = dOptions['workers']
+    for iFrame in range(dOptions['frames']):
+        renderer = FractalRenderer(oFractal, center, width, dOptions['size'])
+        renderer.render()
+        renderer.save(f"{dOptions['output']}{iFrame + 1:02d}.png", oPalette)
+        log.info('Frame %d at width %g: %.3fs, %.0f pixels/s %s', iFrame + 1, width,
+                 renderer.getElapsedSeconds(), renderer.getPixelsPerSecond(), oFractal.getRenderInfo())
+        width /= dOptions['zoom']
+    FractalRenderer.shutdown()
+
 def main():
-    """Main function. Builds or uploads depending on options."""
+    """Main function. Opens the app, or renders headless if an output is specified."""
     log.info('Welcome to %s v%s', sAppName, __version__)
     
+    if dOptions['output']:
+        renderBatch()
+        return
     app = FractalsApp(sAppName + ' v' + __version__)
     app.run()
 
-log = configureLogging()
-#dOptions = getOptions()
-main()
\ No newline at end of file
+if __name__ == '__main__':
+    log = configureLogging()
+    dOptions = getOptions()
+    main()
@@ -39,11 +39,7 @@ class ImageMask:
 
     def toImage(self, oPalette: Palette, sFilename: str):
         self.log.info('Saving %s as %s with palette %s', str(self), sFilename, oPalette.sName)
-        rgbArray = np.zeros((self.h, self.w, 3), 'uint8')
-        for x in range(self.w):
-            for y in range(self.h):
-                col = oPalette.getColor(self.aMask[x][y])
-                rgbArray[y, x, :] = col
+        rgbArray = oPalette.getColors(self.aMask.T)
         img = Image.fromarray(rgbArray)
         img.save(sFilename, 'PNG')
 
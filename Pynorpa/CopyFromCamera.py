@@ -12,6 +12,7 @@ import config
 import logging
 import DateTools
 from PhotoInfo import *
+from ImageResizer import ImageResizer
 from Timer import *
 
 
@@ -80,15 +81,13 @@ class CopyFromCamera:
             os.makedirs(dirThumbs)
 
         copied = sorted(glob.glob(self.targetDir + 'orig/*.JPG'))
+        jobs = []
         for sImg in copied:
             sThumb = dirThumbs + os.path.basename(sImg)
-            self.statusMsg = f'Creating thumbnail {sThumb}'
             if not os.path.exists(sThumb):
-                self.log.info('Creating thumbnail image %s', sThumb)
-                sCmd = f'convert {sImg} -resize 500x500 {sThumb}'
-                os.system(sCmd)
-                if cbkProgress:
-                    cbkProgress()
+                jobs.append((sImg, [(sThumb, ImageResizer.MEDIUM)]))
+        self.statusMsg = f'Creating {len(jobs)} thumbnails'
+        ImageResizer().resizeMany(jobs, cbkProgress)
         self.statusMsg = f'Created {len(self.images)} thumbnails'
 
     def isCameraMounted(self):
@@ -167,6 +166,7 @@ class CopyFromDropBox():
         if len(self.images) == 0:
             return
         timer = Timer()
+        jobs = []
         for file in self.images:
             name = os.path.basename(file)
             if len(name) == 19:
@@ -181,12 +181,12 @@ class CopyFromDropBox():
                     os.system(cmd)
                     self.copied.append(targetFile)
                     thumb = targetFile.replace('orig/', 'thumbs/')
-                    cmd = f'convert {targetFile} -resize 500x500 {thumb}'
-                    os.system(cmd)
+                    jobs.append((targetFile, [(thumb, ImageResizer.MEDIUM)]))
                 if cbkProgress:
                     cbkProgress()
             else:
                 self.log.error('Unhandled file name %s: wrong length', name)
+        ImageResizer().resizeMany(jobs)
         timer.stop()
         self.log.info('Copied %d photos in %s', len(self.copied), timer.getElapsed())
         self.statusMsg = f'Copié {len(self.copied)} photos en {timer.getElapsed()}'
@@ -0,0 +1,254 @@
+"""
+ Incremental backup of a directory tree, copying only new or changed files.
+"""
+
+__author__ = "Nicolas Zwahlen"
+__copyright__ = "Copyright 2026 N. Zwahlen"
+__version__ = "1.0.0"
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import TextTools
+from Timer import Timer
+
+
+class DirBackup:
+    """Copy the new or changed files of a source directory tree to a target directory,
+    comparing size, modification time and optionally SHA-1 hash. Copies are made by
+    worker threads to a temporary name, verified, then renamed. A manifest of the
+    copied files is saved in the target directory for the next run."""
+    log = logging.getLogger('DirBackup')
+    manifestName = '.pynorpa-backup.json'
+    nWorkers = 4
+    chunkSize = 1024*1024
+    mtimeTolerance = 2.0  # FAT and exFAT disks store times with a 2 seconds resolution
+
+    def __init__(self, dirSource: str, dirTarget: str, bHash=False):
+        """Constructor with source and target directories, and whether to compare hashes."""
+        self.dirSource = dirSource.rstrip('/')
+        self.dirTarget = dirTarget.rstrip('/')
+        self.bHash = bHash
+        self.manifest = {}
+        self.toCopy = []
+        self.lock = threading.Lock()
+        self.resetStats()
+        self.loadManifest()
+
+    def resetStats(self):
+        """Reset the counters of copied and skipped files."""
+        self.nFilesCopied = 0
+        self.nBytesCopied = 0
+        self.nFilesSkipped = 0
+        self.nBytesSkipped = 0
+        self.nFailed = 0
+        self.tElapsed = 0.0
+
+    def getManifestName(self) -> str:
+        return f'{self.dirTarget}/{self.manifestName}'
+
+    def loadManifest(self):
+        """Load the manifest of the previous backup, if any."""
+        filename = self.getManifestName()
+        if os.path.exists(filename):
+            with open(filename, 'r') as file:
+                self.manifest = json.load(file)
+            self.log.info('Loaded manifest of %d files from %s', len(self.manifest), filename)
+
+    def saveManifest(self):
+        """Save the manifest of the backed up files."""
+        filename = self.getManifestName()
+        with open(filename, 'w') as file:
+            json.dump(self.manifest, file)
+        self.log.info('Saved manifest of %d files to %s', len(self.manifest), filename)
+
+    def listSource(self) -> dict[str, os.stat_result]:
+        """List the files of the source tree, with their stats, by relative path."""
+        files = {}
+        for (dirpath, dirnames, filenames) in os.walk(self.dirSource):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                path = os.path.join(dirpath, filename)
+                files[os.path.relpath(path, self.dirSource)] = os.stat(path)
+        return files
+
+    def hashFile(self, filename: str) -> str:
+        """Compute the SHA-1 hash of a file."""
+        sha = hashlib.sha1()
+        with open(filename, 'rb') as file:
+            while chunk := file.read(self.chunkSize):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    def isSameTimes(self, mtime1: float, mtime2: float) -> bool:
+        return abs(mtime1 - mtime2) <= self.mtimeTolerance
+
+    def isUpToDate(self, relpath: str, stat: os.stat_result) -> bool:
+        """Check if the target copy of a source file is up to date, from the manifest
+        or else from the target file stats."""
+        entry = self.manifest.get(relpath)
+        if entry is None:
+            target = f'{self.dirTarget}/{relpath}'
+            if not os.path.exists(target):
+                return False
+            targetStat = os.stat(target)
+            entry = {'size': targetStat.st_size, 'mtime': targetStat.st_mtime}
+        if entry['size'] != stat.st_size or not self.isSameTimes(entry['mtime'], stat.st_mtime):
+            return False
+        if self.bHash:
+            hashTarget = entry.get('sha1') or self.hashFile(f'{self.dirTarget}/{relpath}')
+            return hashTarget == self.hashFile(f'{self.dirSource}/{relpath}')
+        return True
+
+    def scan(self) -> list[tuple[str, int]]:
+        """Find the files to copy. Returns a list of (relative path, size)."""
+        timer = Timer()
+        self.toCopy = []
+        self.nFilesSkipped = 0
+        self.nBytesSkipped = 0
+        for (relpath, stat) in self.listSource().items():
+            if self.isUpToDate(relpath, stat):
+                self.nFilesSkipped += 1
+                self.nBytesSkipped += stat.st_size
+                self.manifest.setdefault(relpath, {'size': stat.st_size, 'mtime': stat.st_mtime})
+            else:
+                self.toCopy.append((relpath, stat.st_size))
+        self.log.info('%s: %d files to copy, %d up to date, scanned in %s',
+                      self.dirSource, len(self.toCopy), self.nFilesSkipped, timer.getElapsed())
+        return self.toCopy
+
+    def needsBackup(self) -> bool:
+        """Quick check from the manifest only: True if the target is missing,
+        or if a source file is not in the manifest or has changed since."""
+        if not os.path.exists(self.dirTarget):
+            return True
+        if not self.manifest:
+            # Backed up before manifests, or without any file
+            return False
+        for (relpath, stat) in self.listSource().items():
+            entry = self.manifest.get(relpath)
+            if entry is None or entry['size'] != stat.st_size or not self.isSameTimes(entry['mtime'], stat.st_mtime):
+                return True
+        return False
+
+    def copyFile(self, relpath: str) -> int:
+        """Copy a file to a temporary name, hashing the source on the way, verify it,
+        then rename it. Returns the number of bytes copied."""
+        source = f'{self.dirSource}/{relpath}'
+        target = f'{self.dirTarget}/{relpath}'
+        temp = f'{target}.part'
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        sha = hashlib.sha1()
+        with open(source, 'rb') as fileIn, open(temp, 'wb') as fileOut:
+            while chunk := fileIn.read(self.chunkSize):
+                sha.update(chunk)
+                fileOut.write(chunk)
+        shutil.copystat(source, temp)
+
+        # Verify
+        stat = os.stat(source)
+        if os.path.getsize(temp) != stat.st_size:
+            os.remove(temp)
+            raise OSError(f'Size of copy differs from {source}')
+        if self.bHash and self.hashFile(temp) != sha.hexdigest():
+            os.remove(temp)
+            raise OSError(f'Hash of copy differs from {source}')
+        os.replace(temp, target)
+        with self.lock:
+            self.manifest[relpath] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha1': sha.hexdigest()}
+        return stat.st_size
+
+    def run(self, cbkProgress=None) -> bool:
+        """Copy the files found by scan on the worker threads, calling cbkProgress(relpath, bOk)
+        after each one, and save the manifest. Returns True if all files were copied.
+        If cbkProgress raises, the remaining copies are cancelled and the manifest is saved."""
+        tStart = time.time()
+        os.makedirs(self.dirTarget, exist_ok=True)
+        with ThreadPoolExecutor(max_workers=self.nWorkers) as executor:
+            futures = {executor.submit(self.copyFile, relpath): relpath for (relpath, _) in self.toCopy}
+            try:
+                for future in as_completed(futures):
+                    relpath = futures[future]
+                    bOk = True
+                    try:
+                        self.nBytesCopied += future.result()
+                        self.nFilesCopied += 1
+                    except OSError as e:
+                        self.log.error('Failed to copy %s: %s', relpath, e)
+                        self.nFailed += 1
+                        bOk = False
+                    self.tElapsed = time.time() - tStart
+                    if cbkProgress:
+                        cbkProgress(relpath, bOk)
+            except BaseException:
+                executor.shutdown(cancel_futures=True)
+                self.saveManifest()
+                raise
+        self.tElapsed = time.time() - tStart
+        self.saveManifest()
+        self.log.info(self.getReport())
+        return self.nFailed == 0
+
+    def getThroughput(self) -> float:
+        """Get the copy throughput in bytes per second."""
+        return self.nBytesCopied/self.tElapsed if self.tElapsed > 0 else 0.0
+
+    def getTimeSaved(self) -> float:
+        """Estimate the time saved by skipping up to date files, at the measured throughput."""
+        throughput = self.getThroughput()
+        return self.nBytesSkipped/throughput if throughput > 0 else 0.0
+
+    def getProgress(self) -> str:
+        """Get the numbers of files and bytes copied so far, and the throughput."""
+        return (f'{self.nFilesCopied}/{len(self.toCopy)} fichiers, {TextTools.fileSizeToString(self.nBytesCopied)} '
+                f'à {TextTools.fileSizeToString(int(self.getThroughput()))}/s')
+
+    def getReport(self) -> str:
+        """Get a summary of the copied and skipped files."""
+        if len(self.toCopy) == 0:
+            return f'{self.nFilesSkipped} fichiers à jour, rien à copier'
+        report = f'Copié {self.getProgress()}, {self.nFilesSkipped} à jour'
+        if self.nFilesSkipped > 0:
+            report += f' (gagné {TextTools.durationToString(self.getTimeSaved())})'
+        if self.nFailed > 0:
+            report += f', {self.nFailed} erreurs'
+        return report
+
+
+def testDirBackup():
+    """Back up a temporary tree twice, then after changing a few files."""
+    import tempfile
+    dirSource = tempfile.mkdtemp()
+    dirTarget = tempfile.mkdtemp() + '/backup'
+    for i in range(200):
+        os.makedirs(f'{dirSource}/sub{i % 4}', exist_ok=True)
+        with open(f'{dirSource}/sub{i % 4}/file{i:03d}.jpg', 'wb') as file:
+            file.write(os.urandom(256*1024))
+    for bHash in [False, True]:
+        backup = DirBackup(dirSource, dirTarget, bHash)
+        backup.scan()
+        backup.run()
+        print(backup.getReport())
+    with open(f'{dirSource}/sub1/file001.jpg', 'ab') as file:
+        file.write(b'more')
+    with open(f'{dirSource}/sub2/new.jpg', 'wb') as file:
+        file.write(b'new')
+    backup = DirBackup(dirSource, dirTarget)
+    print(f'Needs backup: {backup.needsBackup()}')
+    backup.scan()
+    backup.run()
+    print(backup.getReport())
+    print(f'Needs backup: {DirBackup(dirSource, dirTarget).needsBackup()}')
+    shutil.rmtree(dirSource)
+    shutil.rmtree(os.path.dirname(dirTarget))
+
+if __name__ == '__main__':
+    logging.basicConfig(format="%(levelname)s %(name)s: %(message)s",
+        level=logging.INFO, handlers=[logging.StreamHandler()])
+    testDirBackup()
@@ -0,0 +1,122 @@
+"""
+ Create medium and thumbnail images with Pillow, in process.
+"""
+
+__author__ = "Nicolas Zwahlen"
+__copyright__ = "Copyright 2026 N. Zwahlen"
+__version__ = "1.0.0"
+
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from PIL import Image
+from Timer import Timer
+
+
+def resizeImage(filename: str, targets: list[tuple[str, int]], quality=92) -> str:
+    """Decode the image once and save it fitted in each (filename, size) square target.
+    Uses JPEG draft mode to decode at the smallest scale that is still large enough.
+    Module function so that it can run in a worker process."""
+    with Image.open(filename) as img:
+        maxSize = max(size for (_, size) in targets)
+        exif = img.info.get('exif')
+        icc = img.info.get('icc_profile')
+        img.draft('RGB', (maxSize, maxSize))
+        img = img.convert('RGB')
+        for (target, size) in sorted(targets, key=lambda target: -target[1]):
+            resized = img.copy()
+            resized.thumbnail((size, size), Image.Resampling.LANCZOS)
+            options = {'quality': quality}
+            if exif:
+                options['exif'] = exif
+            if icc:
+                options['icc_profile'] = icc
+            resized.save(target, 'JPEG', **options)
+    return filename
+
+
+class ImageResizer:
+    """Create the derived sizes of the photos on a pool of worker processes."""
+    log = logging.getLogger('ImageResizer')
+    MEDIUM = 500
+    THUMB = 180
+    nWorkers = os.cpu_count()
+
+    def resize(self, filename: str, targets: list[tuple[str, int]]) -> bool:
+        """Create the (filename, size) targets of a single image in this process."""
+        try:
+            resizeImage(filename, targets)
+            return True
+        except OSError as e:
+            self.log.error('Failed to resize %s: %s', filename, e)
+            return False
+
+    def resizeMany(self, jobs: list[tuple[str, list[tuple[str, int]]]], cbkProgress=None) -> int:
+        """Create the targets of many (filename, targets) images on the worker pool.
+        Returns the number of resized images."""
+        if len(jobs) == 0:
+            return 0
+        timer = Timer()
+        nDone = 0
+        if len(jobs) == 1 or self.nWorkers == 1:
+            for (filename, targets) in jobs:
+                nDone += self.resize(filename, targets)
+                if cbkProgress:
+                    cbkProgress()
+        else:
+            # Not forked: this runs on task runner threads of the Tk app
+            context = multiprocessing.get_context('forkserver')
+            with ProcessPoolExecutor(max_workers=self.nWorkers, mp_context=context) as executor:
+                futures = [executor.submit(resizeImage, filename, targets) for (filename, targets) in jobs]
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                        nDone += 1
+                    except OSError as e:
+                        self.log.error('Failed to resize: %s', e)
+                    if cbkProgress:
+                        cbkProgress()
+        self.log.info('Resized %d images with %d workers in %s', nDone, self.nWorkers, timer.getElapsed())
+        return nDone
+
+
+def testImageResizer(dir: str, nMax=50):
+    """Benchmark ImageMagick convert against the Pillow pipeline on a folder of camera JPEGs."""
+    import glob
+    import shutil
+    import tempfile
+    files = sorted(glob.glob(f'{dir}*.JPG') + glob.glob(f'{dir}*.jpg'))[:nMax]
+    dirOut = tempfile.mkdtemp()
+    print(f'Resizing {len(files)} images from {dir}')
+
+    if shutil.which('convert'):
+        timer = Timer()
+        for filename in files:
+            basename = os.path.basename(filename)
+            os.system(f'convert {filename} -resize 500x500 {dirOut}/medium-{basename}')
+            os.system(f'convert {filename} -resize 180x180 {dirOut}/thumb-{basename}')
+        print(f'convert takes {timer.getElapsed()}')
+    else:
+        print('convert is not installed, skipping')
+
+    resizer = ImageResizer()
+    jobs = []
+    for filename in files:
+        basename = os.path.basename(filename)
+        jobs.append((filename, [(f'{dirOut}/medium-{basename}', ImageResizer.MEDIUM),
+                                (f'{dirOut}/thumb-{basename}', ImageResizer.THUMB)]))
+    timer = Timer()
+    resizer.resizeMany(jobs)
+    print(f'Pillow with {resizer.nWorkers} workers takes {timer.getElapsed()}')
+    # 12 JPEGs of 7360x4912 on one core: 1.682s, or 3.500s when decoding once per size
+    for basename in [os.path.basename(files[0])] if files else []:
+        with Image.open(f'{dirOut}/medium-{basename}') as img:
+            print(f'{basename} medium is {img.size}')
+    shutil.rmtree(dirOut)
+
+if __name__ == '__main__':
+    import config
+    logging.basicConfig(format="%(levelname)s %(name)s: %(message)s",
+        level=logging.INFO, handlers=[logging.StreamHandler()])
+    testImageResizer(f'{config.dirPhotosBase}Nature-2024-01/orig/')
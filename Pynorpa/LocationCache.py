@@ -7,7 +7,10 @@ __copyright__ = "Copyright 2024 N. Zwahlen"
 __version__ = "1.0.0"
 
 import config
+import heapq
 import logging
+import math
+import random
 import geopy.distance
 import numpy as np
 
@@ -125,9 +128,129 @@ class Location:
         return f'Location {self.idx} {self.name} ({self.alt}m)'
     
 
+class LocationIndex:
+    """KD-tree of locations on unit-sphere coordinates, for nearest-neighbour queries.
+    The chord length between unit vectors grows with the great-circle distance,
+    so the tree finds the spherical nearest candidates in sub-linear time.
+    Geodesic distances on the ellipsoid differ from spherical ones by less than 0.5%,
+    so candidates within a 2% margin are checked with exact geodesic distances."""
+    log = logging.getLogger('LocationIndex')
+    margin = 1.02
+
+    def __init__(self, locations: list[Location]):
+        """Constructor from list of locations."""
+        self.root = None
+        self.size = 0
+        self.order = {}
+        points = []
+        for loc in locations:
+            if loc.lat is not None and loc.lon is not None:
+                self.order[loc.idx] = len(self.order)
+                points.append((self.toXYZ(loc.lat, loc.lon), loc))
+        self.root = self.build(points, 0)
+        self.size = len(points)
+        self.log.info(f'Built KD-tree of {self.size} locations')
+
+    def toXYZ(self, lat: float, lon: float) -> tuple:
+        """Convert lat/lon in degrees to a unit vector."""
+        phi = math.radians(lat)
+        lam = math.radians(lon)
+        return (math.cos(phi)*math.cos(lam), math.cos(phi)*math.sin(lam), math.sin(phi))
+
+    def build(self, points: list, depth: int) -> list:
+        """Build a balanced subtree. Nodes are [xyz, location, axis, left, right] lists."""
+        if not points:
+            return None
+        axis = depth % 3
+        points.sort(key=lambda pt: pt[0][axis])
+        iMid = len(points) // 2
+        (xyz, loc) = points[iMid]
+        return [xyz, loc, axis, self.build(points[:iMid], depth+1), self.build(points[iMid+1:], depth+1)]
+
+    def add(self, loc: Location):
+        """Add a location to the tree, without rebalancing."""
+        if loc.lat is None or loc.lon is None:
+            return
+        self.order.setdefault(loc.idx, len(self.order))
+        node = [self.toXYZ(loc.lat, loc.lon), loc, 0, None, None]
+        self.size += 1
+        if self.root is None:
+            self.root = node
+            return
+        parent = self.root
+        while True:
+            axis = parent[2]
+            iChild = 3 if node[0][axis] < parent[0][axis] else 4
+            if parent[iChild] is None:
+                node[2] = (axis + 1) % 3
+                parent[iChild] = node
+                return
+            parent = parent[iChild]
+
+    def getNearestChords(self, xyz: tuple, k: int) -> list:
+        """Get the k nearest nodes as (-squared chord, order, location) max-heap entries."""
+        heap = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node is None:
+                continue
+            d2 = sum((a - b)*(a - b) for (a, b) in zip(xyz, node[0]))
+            entry = (-d2, -self.order[node[1].idx], node[1])
+            if len(heap) < k:
+                heapq.heappush(heap, entry)
+            elif entry > heap[0]:
+                heapq.heapreplace(heap, entry)
+            diff = xyz[node[2]] - node[0][node[2]]
+            (near, far) = (node[3], node[4]) if diff < 0 else (node[4], node[3])
+            if len(heap) < k or diff*diff < -heap[0][0]:
+                stack.append(far)
+            stack.append(near)
+        return heap
+
+    def getWithinChord(self, xyz: tuple, chord: float) -> list[Location]:
+        """Get all locations within the specified chord length."""
+        result = []
+        r2 = chord*chord
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node is None:
+                continue
+            if sum((a - b)*(a - b) for (a, b) in zip(xyz, node[0])) <= r2:
+                result.append(node[1])
+            diff = xyz[node[2]] - node[0][node[2]]
+            if diff < 0 or diff*diff <= r2:
+                stack.append(node[3])
+            if diff >= 0 or diff*diff <= r2:
+                stack.append(node[4])
+        return result
+
+    def getNearest(self, lat: float, lon: float, k=1) -> list:
+        """Get the k nearest locations to lat/lon, as location-distance pairs 
+        sorted by exact geodesic distance in meters."""
+        if self.size == 0:
+            return []
+        xyz = self.toXYZ(lat, lon)
+        heap = self.getNearestChords(xyz, k)
+        chordMax = math.sqrt(max(-entry[0] for entry in heap))
+        angle = min(math.pi, 2*math.asin(min(1.0, chordMax/2))*self.margin + 1e-9)
+        candidates = self.getWithinChord(xyz, 2*math.sin(angle/2))
+        result = [(loc, loc.getDistance(lat, lon)) for loc in candidates]
+        result = sorted(result, key=lambda x: (x[1], self.order[x[0].idx]))
+        return result[:k]
+
+
 class LocationDistanceCache:
-    """Class to store distances between locations, to avoid recomputing."""
+    """Class to store distances between locations, to avoid recomputing.
+    Distances are stored as a float32 upper triangle packed by columns, 
+    so that the distances of a new location are appended at the end.
+    They are computed with Lambert's formula on the WGS-84 ellipsoid,
+    which stays within a few meters of the geodesic distance up to hundreds of km."""
     log = logging.getLogger('LocationDistanceCache')
+    radius = 6378137.0
+    flattening = 1/298.257223563
+    blockSize = 1000000
 
     def __init__(self, locations: list[Location]):
         """Constructor from list of locations."""
@@ -139,23 +262,81 @@ class LocationDistanceCache:
             maxIdx = max(maxIdx, loc.idx)
         self.log.info(f'Max idxLocation is {maxIdx} out of {len(locations)}')
 
-        # Build square matrix and fill it with haversine distances
-        self.matrix = np.zeros((maxIdx, maxIdx), dtype=float)
-        self.log.debug(f'Matrix shape {self.matrix.shape}')
-        for loci in locations:
-            i = loci.idx -1
-            for locj in locations:
-                j = locj.idx -1
-                if i < j:
-                    dist = loci.getDistance(locj.lat, locj.lon)
-                    self.matrix[i][j] = dist
-                    self.matrix[j][i] = dist
+        # Coordinates by idxLocation-1, NaN for unused indices
+        self.size = maxIdx
+        self.lat = np.full(maxIdx, np.nan)
+        self.lon = np.full(maxIdx, np.nan)
+        for loc in locations:
+            self.lat[loc.idx -1] = loc.lat
+            self.lon[loc.idx -1] = loc.lon
+
+        # Fill the packed triangle by blocks of rows
+        self.triangle = np.empty(self.getPackedSize(maxIdx), dtype=np.float32)
+        j0 = 1
+        while j0 < maxIdx:
+            j1 = j0 + 1
+            while j1 < maxIdx and self.getPackedSize(j1 + 1) - self.getPackedSize(j0) < self.blockSize:
+                j1 += 1
+            rows = np.arange(j0, j1)
+            counts = rows
+            start = self.getPackedSize(j0)
+            end = self.getPackedSize(j1)
+            iRows = np.repeat(rows, counts)
+            iCols = np.arange(start, end) - np.repeat(rows*(rows -1)//2, counts)
+            self.triangle[start:end] = self.computeDistances(
+                self.lat[iRows], self.lon[iRows], self.lat[iCols], self.lon[iCols])
+            j0 = j1
+
+    def getPackedSize(self, n: int) -> int:
+        """Get the size of the packed upper triangle for n locations."""
+        return n*(n -1)//2
+
+    def computeDistances(self, lat1, lon1, lat2, lon2):
+        """Compute distances in meters between arrays of coordinates in degrees, 
+        using Lambert's formula for long lines on the ellipsoid."""
+        f = self.flattening
+        beta1 = np.arctan((1 - f)*np.tan(np.radians(lat1)))
+        beta2 = np.arctan((1 - f)*np.tan(np.radians(lat2)))
+        dLon = np.radians(lon2 - lon1)
+        hav = np.sin((beta2 - beta1)/2)**2 + np.cos(beta1)*np.cos(beta2)*np.sin(dLon/2)**2
+        sigma = 2*np.arcsin(np.sqrt(np.clip(hav, 0, 1)))
+        p = (beta1 + beta2)/2
+        q = (beta2 - beta1)/2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x = (sigma - np.sin(sigma))*np.sin(p)**2*np.cos(q)**2/np.cos(sigma/2)**2
+            y = (sigma + np.sin(sigma))*np.cos(p)**2*np.sin(q)**2/np.sin(sigma/2)**2
+            dist = self.radius*(sigma - f/2*(x + y))
+        return np.where(sigma > 0, dist, 0)
+
+    def add(self, loc: Location):
+        """Add or move a location, computing only its distances to the others."""
+        i = loc.idx -1
+        if i >= self.size:
+            nNew = i + 1
+            self.lat = np.concatenate([self.lat, np.full(nNew - self.size, np.nan)])
+            self.lon = np.concatenate([self.lon, np.full(nNew - self.size, np.nan)])
+            self.triangle = np.concatenate([self.triangle, np.full(self.getPackedSize(nNew) - len(self.triangle), np.nan, dtype=np.float32)])
+            self.size = nNew
+        self.lat[i] = loc.lat
+        self.lon[i] = loc.lon
+        dists = self.computeDistances(loc.lat, loc.lon, self.lat, self.lon)
+        # Column i holds the distances to lower indices, row i the higher ones
+        start = self.getPackedSize(i)
+        self.triangle[start:start + i] = dists[:i]
+        higher = np.arange(i + 1, self.size)
+        self.triangle[higher*(higher -1)//2 + i] = dists[i +1:]
 
     def getDistance(self, loc1: Location, loc2: Location) -> float:
         """Get the cached distance between locations."""
         if loc1 is None or loc2 is None:
             return None
-        return self.matrix[loc1.idx -1][loc2.idx -1]
+        i = loc1.idx -1
+        j = loc2.idx -1
+        if i == j:
+            return 0.0
+        if i > j:
+            (i, j) = (j, i)
+        return float(self.triangle[self.getPackedSize(j) + i])
 
 
 class LocationCache:
@@ -179,18 +360,46 @@ class LocationCache:
         """Fetch and store the location records."""
         self.locations = []
         self.distanceCache = None
+        self.index = None
+        self.maxIdx = 0
         self.db = Database.Database(config.dbName)
+        self.fetchLocations('1=1')
+        self.log.info('Done loading %s', self)
+
+    def refresh(self) -> int:
+        """Fetch the locations inserted since the last load, using the max idx as watermark.
+        Return the number of new locations."""
+        locations = self.fetchLocations('idxLocation > %s', (self.maxIdx,))
+        if locations:
+            self.locations = sorted(self.locations, key=lambda loc: loc.name)
+            self.index = None
+            if self.distanceCache is not None:
+                for loc in locations:
+                    self.distanceCache.add(loc)
+        self.log.info(f'Refreshed {len(locations)} new locations from DB')
+        return len(locations)
+
+    def fetchLocations(self, where: str, params=None) -> list[Location]:
+        """Fetch Location records from a where-clause and add them to cache."""
+        locations = []
         self.db.connect(config.dbUser, config.dbPass)
         query = Database.Query("Locations fetch")
         query.add('select idxLocation, locName, locDesc, locLatitude, locLongitude,')
         query.add('locAltitude, locRegion, locMapZoom, locState')
-        query.add('from Location order by locName asc')
-        rows = self.db.fetch(query.getSQL())
+        query.add(f'from Location where {where} order by locName asc')
+        rows = self.db.fetch(query.getSQL(), params)
         for row in rows:
-            self.locations.append(Location(*row))
+            loc = Location(*row)
+            self.locations.append(loc)
+            self.maxIdx = max(self.maxIdx, loc.idx)
+            locations.append(loc)
         self.db.disconnect()
         query.close()
-        self.log.info('Done loading %s', self)
+        return locations
+
+    def transaction(self):
+        """Context to group several writes into a single database commit."""
+        return self.db.transaction(config.dbUser, config.dbPass)
 
     def save(self, obj: Location):
         """Insert or update the specified Location in database."""
@@ -218,6 +427,8 @@ class LocationCache:
         self.db.execute(query.getSQL())
         self.db.disconnect()
         query.close()
+        # Coordinates may have been edited
+        self.index = None
         self.log.info('Saved %s', location)
 
     def insert(self, obj: Location):
@@ -245,8 +456,11 @@ class LocationCache:
             self.log.info(f'Inserted with idx {idx}')
             obj.idx = idx
             self.locations.append(obj)
-            # Invalidate location distances cache
-            self.distanceCache = None
+            self.maxIdx = max(self.maxIdx, idx)
+            if self.index is not None:
+                self.index.add(obj)
+            if self.distanceCache is not None:
+                self.distanceCache.add(obj)
         else:
             self.log.error('No idx after insertion!')
 
@@ -268,8 +482,23 @@ class LocationCache:
                 return loc
         return None
 
+    def getIndex(self) -> LocationIndex:
+        """Get the spatial index of locations, building it if needed."""
+        if self.index is None:
+            self.index = LocationIndex(self.getLocations())
+        return self.index
+
     def getClosest(self, lat: float, lon: float) -> Location:
         """Find the closest location in this cache to the specified lat/lon."""
+        if lat is None or lon is None:
+            return None
+        nearest = self.getIndex().getNearest(lat, lon)
+        if nearest and nearest[0][1] < 100000:
+            return nearest[0][0]
+        return None
+
+    def getClosestBruteForce(self, lat: float, lon: float) -> Location:
+        """Find the closest location by computing the distance to all locations."""
         if lat is None or lon is None:
             return None
         closest = None
@@ -280,26 +509,34 @@ class LocationCache:
                 closest = loc
                 minDist = dist
         return closest
+
+    def getNearest(self, lat: float, lon: float, k: int) -> list:
+        """Get the k nearest locations to the specified lat/lon. Returns location-distance pairs."""
+        if lat is None or lon is None:
+            return []
+        return self.getIndex().getNearest(lat, lon, k)
     
     def getClosestList(self, loc: Location, maxCount=4, maxDist=10000) -> list:
         """Get the list of closest locations to another location. Returns location-distance pairs."""
         self.log.info(f'Looking for locations close to {loc}')
         closest = []
-        for loc2 in self.getLocations():
-            if loc2.idx != loc.idx: 
-                dist = loc.getDistance(loc2.lat, loc2.lon)
-                if dist < maxDist:
-                    closest.append((loc2, dist))
-        closest = sorted(closest, key=lambda x: x[1])
+        for (loc2, dist) in self.getNearest(loc.lat, loc.lon, maxCount+1):
+            if loc2.idx != loc.idx and dist < maxDist:
+                closest.append((loc2, dist))
         #for result in closest[:maxCount]:
         #    self.log.info(f'  {result[0].name} at {result[1]:.1f}m')
         return closest[:maxCount]
     
+    def getDistanceCache(self) -> LocationDistanceCache:
+        """Get the location distances cache, building it if needed."""
+        if self.distanceCache is None:
+            self.distanceCache = LocationDistanceCache(self.getLocations())
+        return self.distanceCache
+
     def getClosestListCached(self, loc: Location, maxCount=4, maxDist=10000) -> list:
         self.log.info(f'Looking for locations close to {loc} in dist cache')
         closest = []
-        if self.distanceCache is None:
-            self.distanceCache = LocationDistanceCache(self.getLocations())
+        self.getDistanceCache()
         for loc2 in self.getLocations():
             if loc2.idx != loc.idx: 
                 dist = self.distanceCache.getDistance(loc, loc2)
@@ -354,6 +591,62 @@ def testAllDistances():
     cache.log.info(f'Done in {timer.getElapsed()}')
     # brute-force takes 2.047s
 
+def testSpatialIndex():
+    """Performance test of the spatial index against brute-force, without database."""
+    log = LocationCache.log
+    random.seed(42)
+    for nLocs in [1000, 10000, 100000]:
+        cache = object.__new__(LocationCache)
+        cache.locations = [Location(i, f'loc{i}', None, random.uniform(45.8, 47.8), random.uniform(5.9, 10.5),
+                                    500, 'Vaud', 16, 'Suisse') for i in range(1, nLocs+1)]
+        cache.index = None
+        queries = [(random.uniform(45.8, 47.8), random.uniform(5.9, 10.5)) for i in range(20)]
+        timer = Timer()
+        cache.getIndex()
+        tBuild = timer.getElapsed()
+        timer = Timer()
+        indexed = [cache.getClosest(lat, lon) for (lat, lon) in queries]
+        tIndexed = timer.getElapsed()
+        timer = Timer()
+        brute = [cache.getClosestBruteForce(lat, lon) for (lat, lon) in queries]
+        tBrute = timer.getElapsed()
+        nSame = sum(1 for (a, b) in zip(indexed, brute) if a is b)
+        log.info(f'{nLocs} locations: index built in {tBuild}, {len(queries)} queries '
+                 f'indexed {tIndexed} brute-force {tBrute}, {nSame} identical results')
+    # 1000 locations: indexed 0.007s brute-force 3.318s
+    # 100000 locations: index built in 0.564s, indexed 0.009s brute-force 239.691s
+
+def testDistancesCacheAccuracy():
+    """Compare the vectorized distances cache to geopy, without database."""
+    log = LocationDistanceCache.log
+    random.seed(42)
+    for nLocs in [500, 2000]:
+        locations = [Location(i, f'loc{i}', None, random.uniform(45.8, 47.8), random.uniform(5.9, 10.5),
+                              500, 'Vaud', 16, 'Suisse') for i in range(1, nLocs+1)]
+        timer = Timer()
+        cache = LocationDistanceCache(locations[:-1])
+        cache.add(locations[-1])
+        tVector = timer.getElapsed()
+        timer = Timer()
+        matrix = np.zeros((nLocs, nLocs), dtype=float)
+        for loci in locations:
+            for locj in locations:
+                if loci.idx < locj.idx:
+                    matrix[loci.idx -1][locj.idx -1] = loci.getDistance(locj.lat, locj.lon)
+        tGeopy = timer.getElapsed()
+        maxErr = 0.0
+        maxRelErr = 0.0
+        for loci in locations:
+            for locj in locations:
+                if loci.idx < locj.idx:
+                    exact = matrix[loci.idx -1][locj.idx -1]
+                    err = abs(cache.getDistance(loci, locj) - exact)
+                    maxErr = max(maxErr, err)
+                    maxRelErr = max(maxRelErr, err/exact)
+        log.info(f'{nLocs} locations: vectorized {tVector} geopy {tGeopy}, '
+                 f'max error {maxErr:.3f}m relative {maxRelErr:.2e}')
+    # 2000 locations: vectorized 0.270s geopy 271.372s, max error 0.340m relative 1.47e-06
+
 def testDistancesCache():
     cache = LocationCache()
     timer = Timer()
@@ -366,5 +659,7 @@ if __name__ == '__main__':
     logging.basicConfig(format="%(levelname)s %(name)s: %(message)s", 
         level=logging.INFO, handlers=[logging.StreamHandler()])
     #testLocationCache()
+    testSpatialIndex()
+    testDistancesCacheAccuracy()
     testAllDistances()
     testDistancesCache()
\ No newline at end of file
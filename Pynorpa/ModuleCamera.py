@@ -29,8 +29,9 @@ class ModuleCamera(TabModule):
         self.defLocation = None
         super().__init__(parent, 'Caméra')
 
+        self.runner = TaskRunner(self.window, self.updateTaskDisplay, self.onTasksDone)
         self.copier = CopyFromCamera()
-        self.tracker = GeoTracker(self.copier, self.onAddCoords, self.onBoundingBoxMap)
+        self.tracker = GeoTracker(self.copier, self.runner.wrap(self.onAddCoords), self.runner.wrap(self.onBoundingBoxMap))
         self.cache = LocationCache()
         self.mapWidget = MapWidget()
         self.copierDropBox = CopyFromDropBox()
@@ -53,15 +54,18 @@ class ModuleCamera(TabModule):
         self.tracker.prepare()
         #self.tasks.append(TestMapView(self.onCenterMap, self.onBoundingBoxMap, self.onAddCoords))
         #self.tasks.append(TestPynorpaTask(5, self.updateTaskDisplay))
-        self.tasks.append(CheckDiskSpace())
-        self.tasks.append(CopyFromDropBoxTask(self.copierDropBox, self.updateTaskDisplay))
-        self.tasks.append(MountCameraTask(self.copier, self.updateTaskDisplay))
-        self.tasks.append(CopyFromCameraTask(self.copier, self.updateTaskDisplay))
-        self.tasks.append(GeoTrackerTask(self.tracker, self.copier.getNumberImages(), self.updateTaskDisplay))
-        #self.tasks.append(CreateThumbnailsTask(self.copier, self.updateTaskDisplay))
+        # Tasks run on worker threads, so they update the display through the runner
+        self.runner.clear()
+        taskDiskSpace = self.runner.add(CheckDiskSpace())
+        self.runner.add(CopyFromDropBoxTask(self.copierDropBox, self.runner.notify), [taskDiskSpace])
+        taskMount = self.runner.add(MountCameraTask(self.copier, self.runner.notify), [taskDiskSpace])
+        taskCopy = self.runner.add(CopyFromCameraTask(self.copier, self.runner.notify), [taskMount])
+        self.runner.add(GeoTrackerTask(self.tracker, self.copier.getNumberImages(), self.runner.notify), [taskCopy])
+        #self.runner.add(CreateThumbnailsTask(self.copier, self.runner.notify), [taskCopy])
+        self.tasks = self.runner.tasks
 
     def copyFiles(self):
-        """Start the file copy tasks."""
+        """Start the file copy tasks in the background."""
         self.log.info('Starting %d tasks', len(self.tasks))
         self.isRunning = True
         self.enableWidgets()
@@ -72,12 +76,15 @@ class ModuleCamera(TabModule):
             if not task.isOver():
                 task.prepare()
         self.renderer.drawTasks(self.tasks)
+        self.runner.start()
 
-        for task in self.tasks:
-            if not task.isOver():
-                task.run()
-                if not task.isOver():
-                    break
+    def cancelTasks(self):
+        """Cancel the running tasks."""
+        self.runner.cancel()
+
+    def onTasksDone(self, bSuccess: bool):
+        """Callback when all tasks are over."""
+        self.log.info('Tasks over, %s', 'successful' if bSuccess else 'with failures')
         self.renderer.drawTasks(self.tasks)
         self.setLoadingIcon(True)
         self.isRunning = False
@@ -86,7 +93,6 @@ class ModuleCamera(TabModule):
     def updateTaskDisplay(self):
         """Update the task rendering."""
         self.renderer.drawTasks(self.tasks)
-        self.window.update()
         self.window.update_idletasks()
 
     def openPhotoDir(self):
@@ -138,6 +144,7 @@ class ModuleCamera(TabModule):
 
         # Buttons
         self.btnCopy = self.addButton('Copier', 'run',  self.copyFiles)
+        self.btnCancel = self.addButton('Annuler', 'cancel', self.cancelTasks)
         self.btnOpen = self.addButton('Ouvrir', 'open', self.openPhotoDir)
         #ToolTip(self.btnCopy, 'Copier les photos depuis la carte mémoire')
 
@@ -163,4 +170,5 @@ class ModuleCamera(TabModule):
 
     def enableWidgets(self):
         self.btnCopy.enableWidget(self.defLocation and not self.isRunning)
+        self.btnCancel.enableWidget(self.isRunning)
         self.btnOpen.enableWidget(not self.isRunning)
@@ -15,6 +15,7 @@ from ModuleCamera import *
 from appParam import AppParamCache
 
 import DateTools
+from Database import ConnectionPool
 import moduleLocations
 import moduleSelection
 import moduleReselection
@@ -61,6 +62,10 @@ class PynorpaApp(TabsApp):
         self.setStatus('Welcome to Pynorpa')
         self.loadNotifications()
 
+    def onBeforeClose(self):
+        """Close the pooled database connections."""
+        ConnectionPool.closeAll()
+
     def loadNotifications(self):
         """Load notifications about old backup or upload dates."""
         cache = AppParamCache()
@@ -8,10 +8,13 @@ __version__ = "1.0.1"
 
 import config
 import logging
+import queue
 import shutil
 import time
+import numpy as np
 import TextTools
 
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 from Task import Task
 from CopyFromCamera import *
@@ -24,6 +27,7 @@ class TaskStatus(Enum):
     Running = 1
     Done = 2
     Error = 3
+    Cancelled = 4
 
     def getDisplayName(self) -> str:
         """Get GUI display text."""
@@ -35,6 +39,8 @@ class TaskStatus(Enum):
             return 'Terminé'
         if self == TaskStatus.Error:
             return 'Erreur'
+        if self == TaskStatus.Cancelled:
+            return 'Annulé'
 
     def getIcon(self) -> str:
         """Get GUI display text."""
@@ -44,21 +50,30 @@ class TaskStatus(Enum):
             return 'run'
         if self == TaskStatus.Done:
             return 'ok'
-        if self == TaskStatus.Error:
+        if self == TaskStatus.Error or self == TaskStatus.Cancelled:
             return 'cancel'
 
     def __str__(self):
         return f'TaskStatus {self.name}'
 
 
+class TaskCancelled(Exception):
+    """Raised in a task's thread when it progresses after being cancelled."""
+    pass
+
+
 class PynorpaTask(Task):
     log = logging.getLogger(__name__)
+    etaSmoothing = 0.2
 
     def __init__(self, title: str, desc: str, nStepsTotal: int):
         super().__init__(title, desc, nStepsTotal)
         self.statusCode = TaskStatus.Idle
         self.tStart = None
         self.tEnd   = None
+        self.tLastStep = None
+        self.stepDuration = None
+        self.stepTimes = []
 
     def prepare(self):
         """Prepare this task. Must be done before running."""
@@ -67,33 +82,212 @@ class PynorpaTask(Task):
     def run(self):
         """Run this task."""
         self.tStart = time.time()
+        self.tLastStep = self.tStart
         self.statusCode = TaskStatus.Running
         self.log.info('Running')
 
+    def inc(self):
+        """Increment the task progress and record the duration of the step.
+        Raises TaskCancelled if the task was cancelled."""
+        if self.isCancelled():
+            raise TaskCancelled(self.title)
+        tNow = time.time()
+        if self.tLastStep:
+            dt = tNow - self.tLastStep
+            self.stepTimes.append(dt)
+            if self.stepDuration is None:
+                self.stepDuration = dt
+            else:
+                self.stepDuration = self.etaSmoothing*dt + (1.0 - self.etaSmoothing)*self.stepDuration
+        self.tLastStep = tNow
+        super().inc()
+
     def onDone(self):
         if not self.tEnd:
             self.tEnd = time.time()
         self.statusCode = TaskStatus.Done
+        self.logStepHistogram()
 
     def getStatus(self) -> str:
         sLeft = self.getRemainingTime()
         return f'{self.status} [{self.nStepsDone}/{self.nStepsTotal}] {sLeft}'
-    
+
+    def getThroughput(self) -> float:
+        """Get the smoothed number of steps per second."""
+        if not self.stepDuration:
+            return 0.0
+        return 1.0/self.stepDuration
+
     def getRemainingTime(self) -> str:
-        """Estimate the remaining time."""
+        """Estimate the remaining time from the exponentially smoothed step duration."""
         result = ''
         nTotal = self.nStepsTotal
         nDone  = self.nStepsDone
         if self.tStart and nTotal and nDone and nTotal > 0 and nDone > 0:
-            if nDone < nTotal:
-                tUsed = time.time() - self.tStart
-                tLeft = (nTotal - nDone)*tUsed/nDone
+            if nDone < nTotal and self.stepDuration is not None:
+                tLeft = (nTotal - nDone)*self.stepDuration
                 result = f'reste {TextTools.durationToString(tLeft)}'
             elif nDone >= nTotal and self.tEnd:
                 tUsed = self.tEnd - self.tStart
                 result = f'en {TextTools.durationToString(tUsed)}'
         return result
 
+    def getStepHistogram(self, nBins=8) -> list[tuple[float, float, int]]:
+        """Get the histogram of the step durations as (from, to, count) bins."""
+        if len(self.stepTimes) == 0:
+            return []
+        counts, edges = np.histogram(self.stepTimes, bins=nBins)
+        return [(float(edges[i]), float(edges[i+1]), int(counts[i])) for i in range(len(counts))]
+
+    def logStepHistogram(self):
+        """Log the histogram of the step durations."""
+        if len(self.stepTimes) < 2:
+            return
+        bins = self.getStepHistogram()
+        nMax = max(count for (_, _, count) in bins)
+        lines = [f'{self.title}: {len(self.stepTimes)} steps, mean {np.mean(self.stepTimes):.3f}s, max {max(self.stepTimes):.3f}s']
+        for (tFrom, tTo, count) in bins:
+            lines.append(f'  {tFrom:8.3f}s - {tTo:8.3f}s {count:5d} {"#"*int(40*count/nMax)}')
+        self.log.info('\n'.join(lines))
+
+
+class TaskRunner:
+    """Run PynorpaTasks on worker threads, posting their progress to the Tk loop through a queue.
+    A task starts once the tasks it runs after are done, so independent tasks run concurrently.
+    Tasks must only call the thread-safe notify, or callbacks made with wrap."""
+    log = logging.getLogger('TaskRunner')
+    nWorkers = 4
+    msPoll = 100
+
+    def __init__(self, window, cbkUpdate=None, cbkDone=None):
+        """Constructor with the Tk window, and the callbacks to refresh the display
+        and to call with the overall success when all tasks are over."""
+        self.window = window
+        self.cbkUpdate = cbkUpdate
+        self.cbkDone = cbkDone
+        self.queue = queue.Queue()
+        self.executor = None
+        self.clear()
+
+    def clear(self):
+        """Remove all tasks."""
+        self.tasks = []
+        self.after = {}
+        self.running = set()
+        self.results = {}
+        self.bCancelled = False
+
+    def add(self, task: PynorpaTask, after: list[PynorpaTask] = None) -> PynorpaTask:
+        """Add a task to run once the specified tasks are done."""
+        self.tasks.append(task)
+        self.after[task] = list(after or [])
+        return task
+
+    def notify(self):
+        """Ask to refresh the display. Thread-safe, to use as the cbkUpdate of tasks."""
+        self.queue.put((None, ()))
+
+    def wrap(self, func):
+        """Get a thread-safe version of a callback, that will be called in the Tk loop."""
+        def post(*args):
+            self.queue.put((func, args))
+        return post
+
+    def isRunning(self) -> bool:
+        return self.executor is not None
+
+    def start(self):
+        """Start the tasks that do not wait for others, and polling the queue."""
+        self.log.info('Starting %d tasks on %d threads', len(self.tasks), self.nWorkers)
+        self.running = set()
+        self.results = {}
+        self.bCancelled = False
+        self.executor = ThreadPoolExecutor(max_workers=self.nWorkers, thread_name_prefix='PynorpaTask')
+        self.submitReady()
+        self.window.after(self.msPoll, self.poll)
+
+    def cancel(self):
+        """Cancel the running tasks, and do not start the others."""
+        self.log.info('Cancelling %d running tasks', len(self.running))
+        self.bCancelled = True
+        for task in self.running:
+            task.cancel()
+
+    def submitReady(self):
+        """Submit the tasks whose previous tasks are done, skip those after a failure."""
+        bChanged = True
+        while bChanged:
+            bChanged = False
+            for task in self.tasks:
+                if task in self.running or task in self.results:
+                    continue
+                if task.isOver():
+                    self.results[task] = True
+                elif self.bCancelled or any(self.results.get(prev) is False for prev in self.after[task]):
+                    self.results[task] = False
+                elif all(self.results.get(prev) for prev in self.after[task]):
+                    self.running.add(task)
+                    self.executor.submit(self.runTask, task)
+                else:
+                    continue
+                bChanged = True
+        if len(self.running) == 0:
+            self.onAllDone()
+
+    def runTask(self, task: PynorpaTask):
+        """Run a task in a worker thread, then post its result to the Tk loop."""
+        bSuccess = False
+        try:
+            task.run()
+            bSuccess = task.isOver()
+            if not bSuccess and task.statusCode == TaskStatus.Running:
+                task.statusCode = TaskStatus.Error
+        except TaskCancelled:
+            self.log.info('Cancelled %s', task.title)
+            task.statusCode = TaskStatus.Cancelled
+        except Exception:
+            self.log.exception('Task %s failed', task.title)
+            task.statusCode = TaskStatus.Error
+        self.queue.put((self.onTaskDone, (task, bSuccess)))
+
+    def onTaskDone(self, task: PynorpaTask, bSuccess: bool):
+        """Record the result of a task and start the tasks it allows."""
+        self.log.info('%s %s', task.title, 'done' if bSuccess else 'failed')
+        self.running.discard(task)
+        self.results[task] = bSuccess
+        if self.executor is not None:
+            self.submitReady()
+
+    def onAllDone(self):
+        """Stop polling and call cbkDone with the overall success."""
+        if self.executor is None:
+            return
+        self.executor.shutdown(wait=False)
+        self.executor = None
+        bSuccess = all(self.results.get(task) for task in self.tasks)
+        self.log.info('All tasks over, %s', 'successful' if bSuccess else 'with failures')
+        if self.cbkUpdate:
+            self.cbkUpdate()
+        if self.cbkDone:
+            self.cbkDone(bSuccess)
+
+    def poll(self):
+        """Run the callbacks posted by the worker threads, refreshing the display once."""
+        bUpdate = False
+        while True:
+            try:
+                (func, args) = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if func is None:
+                bUpdate = True
+            else:
+                func(*args)
+        if bUpdate and self.cbkUpdate:
+            self.cbkUpdate()
+        if self.executor is not None:
+            self.window.after(self.msPoll, self.poll)
+
 
 class MountCameraTask(PynorpaTask):
     """Just check that the camera is mounted."""
@@ -212,7 +406,14 @@ class GeoTrackerTask(PynorpaTask):
         self.tracker.loadPhotos()
         self.setDesc(self.tracker.getStatusMessage())
         self.cbkUpdate()
-        self.tracker.setPhotoGPSTags(self.onProgress)
+        try:
+            self.tracker.setPhotoGPSTags(self.onProgress)
+        except FileNotFoundError as e:
+            self.log.error('Cannot tag photos: %s', e)
+            self.setDesc(f'Programme introuvable : {e.filename}')
+            self.statusCode = TaskStatus.Error
+            self.cbkUpdate()
+            return
         self.setDesc(self.tracker.getStatusMessage())
         self.cbkUpdate()
         #self.tracker.buildHtmlPreviews()
@@ -324,6 +525,21 @@ def testTasks():
     task.prepare()
     task.run()
 
+def testTaskRunner():
+    """Run sleeping tasks in the background of a Tk window, the last two concurrently."""
+    import tkinter as tk
+    window = tk.Tk()
+    label = tk.Label(window, text='Starting', justify=tk.LEFT)
+    label.pack()
+    runner = TaskRunner(window)
+    first = runner.add(TestPynorpaTask(3, runner.notify))
+    runner.add(TestPynorpaTask(2, runner.notify), [first])
+    runner.add(TestPynorpaTask(4, runner.notify), [first])
+    runner.cbkUpdate = lambda: label.configure(text='\n'.join(f'{task.desc} {task.getStatus()}' for task in runner.tasks))
+    runner.cbkDone = lambda bSuccess: window.after(1000, window.destroy)
+    runner.start()
+    window.mainloop()
+
 if __name__ == '__main__':
     logging.basicConfig(format="%(levelname)s %(name)s: %(message)s",
         level=logging.INFO, handlers=[logging.StreamHandler()])
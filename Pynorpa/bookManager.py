@@ -17,10 +17,12 @@ from taxon import Taxon, TaxonCache
 from LocationCache import Location, LocationCache
 from picture import Picture, PictureCache
 from Database import Query
-from PhotoInfo import PhotoInfo
+from ImageResizer import ImageResizer
+from PhotoInfo import PhotoInfo, PhotoInfoIndex
 from pynorpaHtml import PynorpaHtmlPage
 from HtmlPage import *
 from pdfDoc import PdfDoc
+from Timer import Timer
 
 class BookPicFilter():
     """Class BookPicFilter"""
@@ -382,10 +384,12 @@ class BookManager():
     def createMediumImages(self, book: Book):
         """Convert book photos to medium size."""
         dir = self.getBookDir(book)
+        jobs = []
         for pib in book.getPictures():
             fileMedium = f'{dir}/medium/{pib.filename}'
             if not os.path.isfile(fileMedium):
-                self.runSystemCommand(f'convert {dir}/photos/{pib.filename} -resize 500x500 {fileMedium}')
+                jobs.append((f'{dir}/photos/{pib.filename}', [(fileMedium, ImageResizer.MEDIUM)]))
+        ImageResizer().resizeMany(jobs)
 
     def createExportImages(self, book: Book):
         """Link the book images to an export dir, prefixed by order."""
@@ -476,34 +480,32 @@ class BookManager():
         self.runSystemCommand(f'evince {filename} &')
 
     def findOriginal(self, pic: Picture) -> PhotoInfo:
-        """Find original picture. Look in disk and backups."""
-        self.log.info(f'Looking for original of {pic}')
+        """Find original picture. Look in disk and backups,
+        through the shot-time index of the month directories."""
+        timer = Timer()
         paths = [config.dirPhotosBase, config.dirElements + 'Pictures/']
         yearMonth = DateTools.datetimeToString(pic.getShotAt(), '%Y-%m')
-        picShotAt = pic.getShotAt().timestamp()
-        for path in paths:
-            dir = f'{path}Nature-{yearMonth}/orig/'
-            self.log.info(f'Looking in {dir}')
-            if os.path.exists(dir):
-                files = sorted(glob.glob(f'{dir}*.JPG'))
-                self.log.info(f'Scanning {len(files)} files...')
-                for file in files:
-                    info = PhotoInfo(file)
-                    info.identify()
-                    if info.getShotAt() == picShotAt:
-                        self.log.info(f'Found original: {info}')
-                        return info
-            else:
-                self.log.info(f'Path does not exist: {dir}')
-        self.log.info(f'Could not find original of {pic}')
+        dirs = [f'{path}Nature-{yearMonth}/orig/' for path in paths]
+        info = PhotoInfoIndex().findByShotAt(pic.getShotAt().timestamp(), dirs)
+        if info:
+            self.log.info(f'Found original of {pic}: {info} in {timer.getElapsed()}')
+        else:
+            self.log.info(f'Could not find original of {pic} in {dirs}, in {timer.getElapsed()}')
+        return info
 
     def findMissingOriginals(self, book: Book):
         """Look for originals of book pictures."""
+        timer = Timer()
+        nMissing = 0
+        nFound = 0
         for pib in book.getPictures():
             if not pib.hasOriginal():
+                nMissing += 1
                 orig = self.findOriginal(pib)
                 if orig:
+                    nFound += 1
                     pib.orig = orig.getNameFull()
+        self.log.info(f'Found {nFound} of {nMissing} missing originals in {timer.getElapsed()}')
         self.saveBook(book)
     
     def runSystemCommand(self, cmd: str, dryrun=False):
@@ -174,11 +174,26 @@ class ExpeditionCache():
         if location:
             exped.setLocation(location)
             location.addExcursion(exped)
-            picture: Picture
-            for picture in location.getPictures():
-                if picture.getShotAt() >= exped.getFrom() and picture.getShotAt() <= exped.getTo():
-                    exped.addPicture(picture)
-            exped.pictures = sorted(exped.pictures, key=lambda pic: pic.shotAt)
+            self.setPictures(exped)
+
+    def setPictures(self, exped: Expedition):
+        """Set the excursion pictures from its location pictures and date-range."""
+        exped.pictures = []
+        picture: Picture
+        for picture in exped.getLocation().getPictures():
+            if picture.getShotAt() >= exped.getFrom() and picture.getShotAt() <= exped.getTo():
+                exped.addPicture(picture)
+        exped.pictures = sorted(exped.pictures, key=lambda pic: pic.shotAt)
+
+    def relinkPictures(self):
+        """Set again the pictures of all excursions, after a picture cache refresh."""
+        for exped in self.getExpeditions():
+            if exped.getLocation():
+                self.setPictures(exped)
+
+    def transaction(self):
+        """Context to group several writes into a single database commit."""
+        return self.db.transaction(config.dbUser, config.dbPass)
 
     def save(self, obj: Expedition):
         """Insert or update the specified Expedition in database."""
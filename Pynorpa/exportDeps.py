@@ -0,0 +1,258 @@
+"""
+Dependency graph and content hashes of the exported web pages,
+allowing incremental exports.
+"""
+
+__author__ = "Nicolas Zwahlen"
+__copyright__ = "Copyright 2026 N. Zwahlen"
+__version__ = "1.0.0"
+
+import hashlib
+import json
+import logging
+import os
+
+from picture import Picture
+from taxon import Taxon
+from expedition import Expedition
+from LocationCache import Location
+
+
+class HashingSink:
+    """File-like sink that hashes the text written to it, and also writes it to a file if any.
+    The optional normalize function is applied to each written chunk before hashing,
+    so the parts it removes must be written in a single call."""
+
+    def __init__(self, filename: str = None, normalize=None):
+        """Constructor with optional file name and normalize function."""
+        self.sha = hashlib.sha1()
+        self.normalize = normalize
+        self.file = open(filename, 'w') if filename else None
+
+    def write(self, text: str):
+        if self.file:
+            self.file.write(text)
+        self.sha.update((self.normalize(text) if self.normalize else text).encode())
+
+    def hexdigest(self) -> str:
+        return self.sha.hexdigest()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ExportDependencies:
+    """Records for each exported file the objects it renders, a hash of these inputs
+    and a hash of its content. A later export only rebuilds the files whose inputs
+    changed, and only writes the files whose content changed."""
+    log = logging.getLogger('ExportDependencies')
+
+    def __init__(self, dirExport: str, version: str):
+        """Constructor with export directory and exporter version."""
+        self.dirExport = dirExport
+        self.filename = f'{dirExport}pynorpa-deps.json'
+        self.version = version
+        self.pages = {}
+        self.signatures = {}
+        self.current = set()
+        self.volatile = False
+        self.resetStats()
+        self.load()
+
+    def load(self):
+        """Load the dependencies of the previous export, if any with the same version."""
+        if not os.path.exists(self.filename):
+            return
+        with open(self.filename, 'r') as file:
+            data = json.load(file)
+        if data.get('version') == self.version:
+            self.pages = data['pages']
+            self.log.info(f'Loaded dependencies of {len(self.pages)} files from {self.filename}')
+        else:
+            self.log.info(f'Exporter version changed from {data.get("version")}, will rebuild all')
+
+    def save(self):
+        """Save the dependencies for the next export."""
+        with open(self.filename, 'w') as file:
+            json.dump({'version': self.version, 'pages': self.pages}, file)
+        self.log.info(f'Saved dependencies of {len(self.pages)} files to {self.filename}')
+
+    def clear(self):
+        """Forget previous dependencies to rebuild all files."""
+        self.pages = {}
+
+    def resetStats(self):
+        """Reset the counters and the list of updated files."""
+        self.nRebuilt = 0
+        self.nSkipped = 0
+        self.nUnchanged = 0
+        self.updates = {}
+
+    def getKey(self, obj) -> str:
+        """Get the dependency key of a cached object."""
+        if isinstance(obj, Picture):
+            return f'pic:{obj.idx}'
+        elif isinstance(obj, Taxon):
+            return f'taxon:{obj.idx}'
+        elif isinstance(obj, Location):
+            return f'loc:{obj.idx}'
+        elif isinstance(obj, Expedition):
+            return f'exc:{obj.idx}'
+        return None
+
+    def getFields(self, obj) -> tuple:
+        """Get the fields of a cached object that may be rendered in a page."""
+        if isinstance(obj, Picture):
+            return (obj.filename, str(obj.shotAt), obj.remarks, obj.idxTaxon, obj.idxLocation, obj.rating)
+        elif isinstance(obj, Taxon):
+            return (obj.name, obj.nameFr, obj.rank.name, obj.idxParent, obj.order, obj.typical,
+                    [child.idx for child in obj.children], [pic.idx for pic in obj.pictures])
+        elif isinstance(obj, Location):
+            return (obj.name, obj.desc, obj.lat, obj.lon, obj.alt, obj.region, obj.state, obj.zoom,
+                    [pic.idx for pic in obj.pictures], [exc.idx for exc in obj.excursions])
+        elif isinstance(obj, Expedition):
+            return (obj.name, obj.desc, obj.idxLocation, str(obj.tfrom), str(obj.to), obj.track,
+                    [pic.idx for pic in obj.pictures])
+        return None
+
+    def computeSignatures(self, pictures: list[Picture], taxa: list[Taxon],
+                          locations: list[Location], excursions: list[Expedition]):
+        """Compute the signature of every cached object. Aggregated keys all:<kind>
+        change when any object of that kind changes, geo:loc when a location is
+        added, renamed or moved."""
+        self.signatures = {}
+        for (kind, objs) in [('pic', pictures), ('taxon', taxa), ('loc', locations), ('exc', excursions)]:
+            sha = hashlib.sha1()
+            for obj in objs:
+                signature = repr(self.getFields(obj))
+                self.signatures[f'{kind}:{obj.idx}'] = signature
+                sha.update(signature.encode())
+            self.signatures[f'all:{kind}'] = sha.hexdigest()
+        sha = hashlib.sha1()
+        for loc in locations:
+            sha.update(repr((loc.idx, loc.name, loc.lat, loc.lon)).encode())
+        self.signatures['geo:loc'] = sha.hexdigest()
+
+    def hashInputs(self, keys: list[str]) -> str:
+        """Hash the current signatures of the specified keys."""
+        sha = hashlib.sha1()
+        for key in keys:
+            sha.update(f'{key}={self.signatures.get(key)}\n'.encode())
+        return sha.hexdigest()
+
+    def hashContent(self, content, normalize=None) -> str:
+        """Hash the content of a file, from its text or from the HashingSink it was streamed to."""
+        if isinstance(content, HashingSink):
+            return content.hexdigest()
+        with HashingSink(None, normalize) as sink:
+            sink.write(content)
+        return sink.hexdigest()
+
+    def hashFile(self, filename: str, normalize=None) -> str:
+        """Hash the content of an existing file, reading it line by line."""
+        with open(filename, 'r') as file, HashingSink(None, normalize) as sink:
+            for line in file:
+                sink.write(line)
+        return self.hashContent(sink)
+
+    def isUpToDate(self, name: str) -> bool:
+        """Check if the file exists and none of its recorded inputs changed."""
+        entry = self.pages.get(name)
+        if entry is None or entry['deps'] is None:
+            return False
+        if not os.path.exists(f'{self.dirExport}{name}'):
+            return False
+        return self.hashInputs(entry['deps']) == entry['inputs']
+
+    def startPage(self, name: str) -> bool:
+        """Start recording the dependencies of a file.
+        Returns False if the file is up to date and does not need to be rebuilt."""
+        if self.isUpToDate(name):
+            self.nSkipped += 1
+            return False
+        self.current = set()
+        self.volatile = False
+        return True
+
+    def startPages(self, names: list[str]) -> bool:
+        """Start recording the dependencies of files built together.
+        Returns False if all of them are up to date."""
+        if all(self.isUpToDate(name) for name in names):
+            self.nSkipped += len(names)
+            return False
+        self.current = set()
+        self.volatile = False
+        return True
+
+    def addDeps(self, *objs):
+        """Record that the current file renders the specified objects, or lists of objects."""
+        for obj in objs:
+            if isinstance(obj, (list, tuple, set)):
+                self.addDeps(*obj)
+            elif isinstance(obj, str):
+                self.current.add(obj)
+            elif obj is not None:
+                self.current.add(self.getKey(obj))
+
+    def setVolatile(self):
+        """Mark the current file as depending on data that is not tracked, so that it is always rebuilt."""
+        self.volatile = True
+
+    def write(self, name: str, content, normalize=None):
+        """Write the content of the current file, unless identical to the existing one,
+        and record its dependencies. The content is a string, or a function writing it
+        to a file-like sink like HtmlPage.write, so that it is streamed to a temporary
+        file while being hashed. The optional normalize function removes the parts
+        of the content to ignore when comparing, like a generation date."""
+        filename = f'{self.dirExport}{name}'
+        temp = f'{filename}.tmp'
+        with HashingSink(temp, normalize) as sink:
+            if callable(content):
+                content(sink)
+            else:
+                sink.write(content)
+        hashContent = self.hashContent(sink)
+        entry = self.pages.get(name)
+        hashPrevious = entry['hash'] if entry else None
+        if hashPrevious is None and os.path.exists(filename):
+            hashPrevious = self.hashFile(filename, normalize)
+
+        if hashContent == hashPrevious and os.path.exists(filename):
+            os.remove(temp)
+            self.nUnchanged += 1
+        else:
+            self.log.info('Saving %s', filename)
+            os.replace(temp, filename)
+            self.nRebuilt += 1
+
+        deps = None if self.volatile else sorted(self.current)
+        entry = {'deps': deps, 'inputs': None if deps is None else self.hashInputs(deps), 'hash': hashContent}
+        self.pages[name] = entry
+        self.updates[name] = entry
+        self.current = set()
+
+    def getCounts(self) -> tuple[int, int, int]:
+        """Get the numbers of rebuilt, skipped and unchanged files."""
+        return (self.nRebuilt, self.nSkipped, self.nUnchanged)
+
+    def getUpdates(self) -> dict:
+        """Get the entries of the files written since the last reset."""
+        return self.updates
+
+    def merge(self, updates: dict, counts: tuple[int, int, int]):
+        """Merge the entries and counts from another process."""
+        self.pages.update(updates)
+        self.nRebuilt += counts[0]
+        self.nSkipped += counts[1]
+        self.nUnchanged += counts[2]
+
+    def __str__(self):
+        return f'{self.nRebuilt} rebuilt, {self.nSkipped} skipped and {self.nUnchanged} unchanged files'
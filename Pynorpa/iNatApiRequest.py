@@ -6,8 +6,14 @@ Find the iNat taxon id for a taxon name.
 Find the ancestor taxa for a taxon id.
 """
 
+import config
+import json
 import logging
 import requests
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 
 class INatTaxon():
@@ -23,9 +29,92 @@ class INatTaxon():
     def __str__(self):
         return f'INatTaxon {self.id} {self.rank} {self.name} ({self.commonName})'
 
+class INatResponseCache:
+    """Singleton on-disk SQLite cache of iNat API responses by URL, expiring after ttl seconds."""
+    log = logging.getLogger('INatResponseCache')
+    _instance = None
+    filename = f'{config.dirPhotosBase}pynorpa-inat.sqlite'
+    ttl = 30*24*3600
+
+    def __new__(cls):
+        """Create a singleton object."""
+        if cls._instance is None:
+            cls._instance = super(INatResponseCache, cls).__new__(cls)
+            cls._instance.log.info('Created the INatResponseCache singleton')
+            cls._instance.open(cls.filename)
+        return cls._instance
+
+    def __init__(self):
+        """Constructor. Unused as all is done in new."""
+        pass
+
+    @classmethod
+    def reset(cls):
+        """Forget the singleton, for example to open another file."""
+        cls._instance = None
+
+    def open(self, filename: str):
+        """Open or create the cache database."""
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.conn.execute('create table if not exists INatResponse (url text primary key, fetchedAt real, body text)')
+        self.conn.commit()
+        self.resetStats()
+        self.log.info('Opened iNat response cache %s', filename)
+
+    def resetStats(self):
+        """Reset the hit and miss counters and latencies."""
+        self.nHits = 0
+        self.nMisses = 0
+        self.tHits = 0.0
+        self.tMisses = 0.0
+
+    def get(self, url: str):
+        """Get the cached response data of a URL, or None if missing or expired."""
+        with self.lock:
+            row = self.conn.execute('select fetchedAt, body from INatResponse where url = ?', (url,)).fetchone()
+        if row is None or time.time() - row[0] > self.ttl:
+            return None
+        return json.loads(row[1])
+
+    def put(self, url: str, data):
+        """Store the response data of a URL."""
+        with self.lock:
+            self.conn.execute('insert or replace into INatResponse values (?, ?, ?)', (url, time.time(), json.dumps(data)))
+            self.conn.commit()
+
+    def addLatency(self, bHit: bool, seconds: float):
+        """Record the latency of a lookup."""
+        with self.lock:
+            if bHit:
+                self.nHits += 1
+                self.tHits += seconds
+            else:
+                self.nMisses += 1
+                self.tMisses += seconds
+
+    def getHitRate(self) -> float:
+        """Get the ratio of lookups served from the cache."""
+        nTotal = self.nHits + self.nMisses
+        return self.nHits/nTotal if nTotal > 0 else 0.0
+
+    def __str__(self):
+        msHit = 1000*self.tHits/self.nHits if self.nHits else 0.0
+        msMiss = 1000*self.tMisses/self.nMisses if self.nMisses else 0.0
+        return (f'INatResponseCache hits: {self.nHits} ({msHit:.1f}ms) misses: {self.nMisses} ({msMiss:.1f}ms) '
+                f'hit rate {100*self.getHitRate():.0f}%')
+
+
 class INatApiRequest():
-    """Class to send taxon info requests to the iNaturalist API."""
+    """Class to send taxon info requests to the iNaturalist API.
+    Responses are cached on disk, and requests are rate limited and may run on a small thread pool."""
     log = logging.getLogger('iNatApiRequest')
+    nWorkers = 4
+    minInterval = 1.0   # iNat asks for at most about one request per second
+    maxIdsPerRequest = 30
+    nRetries = 3
+    _rateLock = threading.Lock()
+    _tLastRequest = 0.0
 
     # Query examples:
     #url = f"https://api.inaturalist.org/v1/observations?user_id={me_id}&quality_grade=needs_id&rank=genus"
@@ -33,6 +122,55 @@ class INatApiRequest():
 
     def __init__(self):
         self.baseUrl = 'https://api.inaturalist.org/v1/taxa'
+        self.cache = INatResponseCache()
+        self.local = threading.local()
+
+    def waitForRateLimit(self):
+        """Wait until minInterval has passed since the previous request of any thread."""
+        with INatApiRequest._rateLock:
+            tWait = INatApiRequest._tLastRequest + self.minInterval - time.time()
+            if tWait > 0:
+                time.sleep(tWait)
+            INatApiRequest._tLastRequest = time.time()
+
+    def getSession(self) -> requests.Session:
+        """Get the HTTP session of this thread, keeping connections alive."""
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def fetchJson(self, url: str):
+        """Get the JSON data of a URL from the cache, or else from the API,
+        retrying after a delay when rate limited. Returns None on failure."""
+        tStart = time.time()
+        data = self.cache.get(url)
+        if data is not None:
+            self.cache.addLatency(True, time.time() - tStart)
+            return data
+        for iTry in range(self.nRetries):
+            self.waitForRateLimit()
+            response = self.getSession().get(url, timeout=30)
+            if response.status_code == 429 or response.status_code >= 500:
+                self.log.warning(f'Got {response.status_code} for {url}, retry {iTry + 1}')
+                time.sleep(self.minInterval*2**iTry)
+                continue
+            data = response.json()
+            if response.status_code == 200:
+                self.cache.put(url, data)
+            break
+        self.cache.addLatency(False, time.time() - tStart)
+        return data
+
+    def fetchMany(self, urls: list[str]) -> list:
+        """Get the JSON data of many URLs on the thread pool, in order. None for failures."""
+        def fetch(url):
+            try:
+                return self.fetchJson(url)
+            except Exception as exc:
+                self.log.error(f'Request to {url} failed: {exc}')
+                return None
+        with ThreadPoolExecutor(max_workers=self.nWorkers) as executor:
+            return list(executor.map(fetch, urls))
 
     def getIdFromName(self, name: str) -> int:
         """Get iNat taxon id from taxon name."""
@@ -43,7 +181,17 @@ class INatApiRequest():
     
     def getTaxonFromName(self, name: str) -> INatTaxon:
         """Get iNat taxon from taxon name."""
-        data = self.sendRequestByName(name)
+        return self.readTaxon(self.sendRequestByName(name), name)
+
+    def getTaxaFromNames(self, names: list[str]) -> dict[str, INatTaxon]:
+        """Get iNat taxa from many taxon names, with concurrent requests."""
+        urls = [self.getUrlByName(name) for name in names]
+        return {name: self.readTaxon(data, name) for (name, data) in zip(names, self.fetchMany(urls))}
+
+    def readTaxon(self, data, name: str) -> INatTaxon:
+        """Extract the taxon with the specified name from data."""
+        if data is None:
+            return None
         self.log.info('Total results: %d', data['total_results'])
         for result in data['results']:
             if result['name'] == name:
@@ -64,33 +212,45 @@ class INatApiRequest():
             self.log.error('Invalid taxon id')
             return None
 
+    def getAncestorsMany(self, ids: list[int]) -> dict[int, list[INatTaxon]]:
+        """Get the ancestor taxa of many taxon ids. The ids that are not cached are
+        requested by lists of up to maxIdsPerRequest, and each result is cached by id."""
+        missing = [id for id in dict.fromkeys(ids) if self.cache.get(self.getUrlById(id)) is None]
+        chunks = [missing[i:i + self.maxIdsPerRequest] for i in range(0, len(missing), self.maxIdsPerRequest)]
+        urls = [self.getUrlById(','.join(str(id) for id in chunk)) for chunk in chunks]
+        for data in self.fetchMany(urls):
+            for result in (data or {}).get('results', []):
+                self.cache.put(self.getUrlById(result['id']), {'total_results': 1, 'results': [result]})
+        return {id: self.readAncestors(self.sendRequestById(id)) for id in ids}
+
+    def getUrlByName(self, name: str) -> str:
+        # https://api.inaturalist.org/v1/taxa?q=Polyommatus%20bellargus
+        return f'{self.baseUrl}?q={name}&locale=fr'
+
+    def getUrlById(self, id) -> str:
+        # https://api.inaturalist.org/v1/taxa/231137 or /v1/taxa/231137,48484
+        return f'{self.baseUrl}/{id}'
+
     def sendRequestByName(self, name: str):
         """Request taxon data from taxon name."""
-        # https://api.inaturalist.org/v1/taxa?q=Polyommatus%20bellargus
-        url = f'{self.baseUrl}?q={name}&locale=fr'
+        url = self.getUrlByName(name)
         self.log.info('Sending request for name %s to %s', name, url)
         data = None
         try:
-            response = requests.get(url)
-            data = response.json()
-            #self.log.info(data)
-            #self.readResponse(data)
+            data = self.fetchJson(url)
         except Exception as exc:
             self.log.error(f'Request by name failed: {exc}')
         return data
 
     def sendRequestById(self, id: int):
         """Request taxon data from taxon id."""
-        # https://api.inaturalist.org/v1/taxa/231137
-        url = f'{self.baseUrl}/{id}'
+        url = self.getUrlById(id)
         self.log.info('Sending request for id %s to %s', id, url)
         data = None
         try:
-            response = requests.get(url)
+            data = self.fetchJson(url)
             # handle requests.exceptions.ConnectionError: ('Connection aborted.', 
             # RemoteDisconnected('Remote end closed connection without response'))
-            data = response.json()
-            #self.log.info(data)
         except Exception as exc:
             self.log.error(f'Request by id failed: {exc}')
         return data
@@ -142,6 +302,81 @@ def testRequest():
     #         for ancestor in ancestors:
     #             req.log.info(ancestor)
 
+def testRequestOffline(nTaxa=60):
+    """Look up taxa and their ancestors on a local mock of the iNat API with 100ms latency,
+    one by one and then in batches, and again from the cache."""
+    import http.server
+    import os
+    import tempfile
+    from Timer import Timer
+    from urllib.parse import urlparse, parse_qs
+
+    def makeResult(id):
+        ancestors = [{'id': 1000 + i, 'name': f'Ancestor{i}', 'rank': rank}
+                     for (i, rank) in enumerate(['kingdom', 'phylum', 'class', 'order', 'family', 'genus'])]
+        return {'id': id, 'name': f'Genus species{id}', 'rank': 'species', 'ancestors': ancestors}
+
+    class MockHandler(http.server.BaseHTTPRequestHandler):
+        nRequests = 0
+
+        def do_GET(self):
+            MockHandler.nRequests += 1
+            time.sleep(0.1)
+            url = urlparse(self.path)
+            if 'q' in parse_qs(url.query):
+                id = int(parse_qs(url.query)['q'][0].split('species')[1])
+                results = [makeResult(id)]
+            else:
+                results = [makeResult(int(id)) for id in url.path.split('/')[-1].split(',')]
+            body = json.dumps({'total_results': len(results), 'results': results}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), MockHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    filename = tempfile.mktemp(suffix='.sqlite')
+    INatResponseCache.reset()
+    INatResponseCache.filename = filename
+    INatApiRequest.minInterval = 0.01
+    logging.getLogger('iNatApiRequest').setLevel(logging.WARNING)
+
+    req = INatApiRequest()
+    req.baseUrl = f'http://127.0.0.1:{server.server_port}/v1/taxa'
+    names = [f'Genus species{i}' for i in range(1, nTaxa + 1)]
+
+    timer = Timer()
+    for name in names:
+        taxon = req.getTaxonFromName(name)
+        req.getAncestors(taxon.id)
+    print(f'One by one: {MockHandler.nRequests} requests in {timer.getElapsed()}, {req.cache}')
+
+    req.cache.conn.execute('delete from INatResponse')
+    req.cache.resetStats()
+    MockHandler.nRequests = 0
+    timer = Timer()
+    taxa = req.getTaxaFromNames(names)
+    ancestors = req.getAncestorsMany([taxon.id for taxon in taxa.values()])
+    print(f'Batched: {MockHandler.nRequests} requests in {timer.getElapsed()}, {req.cache}')
+    # 60 taxa: 120 requests in 12.6s one by one, 62 requests in 1.8s batched, none in 7ms cached
+
+    req.cache.resetStats()
+    MockHandler.nRequests = 0
+    timer = Timer()
+    taxa = req.getTaxaFromNames(names)
+    ancestors = req.getAncestorsMany([taxon.id for taxon in taxa.values()])
+    print(f'Cached: {MockHandler.nRequests} requests in {timer.getElapsed()}, {req.cache}')
+    print(f'{names[0]}: {" > ".join(ancestor.name for ancestor in ancestors[taxa[names[0]].id])}')
+
+    server.shutdown()
+    INatResponseCache.reset()
+    os.remove(filename)
+
 if __name__ == '__main__':
     logging.basicConfig(format="%(levelname)s %(name)s: %(message)s", 
         level=logging.INFO, handlers=[logging.StreamHandler()])
@@ -14,6 +14,7 @@ from tkinter import ttk
 from PIL import ImageTk, Image
 from picture import Picture
 from PhotoInfo import PhotoInfo
+from ImageResizer import ImageResizer
 from BaseWidgets import Button
 
 
@@ -59,7 +60,7 @@ class ImageWidget():
                     fileMedium = picture.filename.replace('photos/', 'thumbs/')
                 if fileMedium and not os.path.exists(fileMedium):
                     self.log.info('Creating medium image for %s', picture.filename)
-                    os.system(f'convert {picture.filename} -resize 500x500 {fileMedium}')
+                    ImageResizer().resize(picture.filename, [(fileMedium, ImageResizer.MEDIUM)])
         self.loadData(fileMedium)
 
     def setDefaultImage(self):
@@ -9,17 +9,19 @@ __version__ = "1.0.0"
 import config
 import logging
 import os
+import time
 
 import tkinter as tk
 from tkinter import ttk
 from pathlib import Path
 
 import DateTools
+import TextTools
 from appParam import AppParamCache
 from BaseWidgets import Button
 from pynorpaManager import PynorpaManager
 from TabsApp import TabsApp, TabModule
-from PynorpaTask import TaskStatus, PynorpaTask, CheckDiskSpace
+from PynorpaTask import TaskStatus, PynorpaTask, TaskRunner, CheckDiskSpace
 
 
 class ModuleBackups(TabModule):
@@ -34,6 +36,7 @@ class ModuleBackups(TabModule):
         self.isRunning = False
         self.apCache = AppParamCache()
         self.manager = PynorpaManager()
+        self.runner = TaskRunner(self.window, self.updateTasks, self.onBackupsDone)
         super().__init__(parent, 'Backups')
 
     def loadData(self):
@@ -48,17 +51,19 @@ class ModuleBackups(TabModule):
 
     def loadTasks(self):
         """Load the tasks to perform."""
-        self.tasks = []
-        self.tasks.append(CheckDiskSpace())
-        self.tasks.append(LocalDbBackup())
-        self.tasks.append(MountBackupDrive())
-        self.tasks.append(CopyDbBackup())
+        self.runner.clear()
+        taskDiskSpace = self.runner.add(CheckDiskSpace())
+        taskDump = self.runner.add(LocalDbBackup(), [taskDiskSpace])
+        taskMount = self.runner.add(MountBackupDrive(), [taskDiskSpace])
+        self.runner.add(CopyDbBackup(), [taskDump, taskMount])
 
-        # Copy or sync pic directories since last backup
+        # Copy or sync pic directories since last backup, one after the other
         dirsToBackup = self.manager.getDirsToBackup()
         if dirsToBackup:
+            taskPrevious = taskMount
             for dir in dirsToBackup:
-                self.tasks.append(BackupPhotoDir(dir, self.updateTasks))
+                taskPrevious = self.runner.add(BackupPhotoDir(dir, self.runner.notify), [taskPrevious])
+        self.tasks = self.runner.tasks
 
     def getTasks(self) -> list[PynorpaTask]:
         return self.tasks
@@ -76,24 +81,22 @@ class ModuleBackups(TabModule):
         """Update task widgets display."""
         for wid in self.taskWidgets:
             wid.loadData()
-            self.window.update_idletasks()
+        self.window.update_idletasks()
 
     def runBackups(self):
-        """Run the backup tasks."""
+        """Run the backup tasks in the background."""
         self.log.info('Running backup tasks')
         self.isRunning = True
         self.enableWidgets()
         self.setLoadingIcon()
+        self.runner.start()
 
-        # Run all tasks
-        bSuccess = True
-        for task in self.getTasks():
-            if not task.isOver():
-                task.run()
-                self.updateTasks()
-                if not task.isOver():
-                    bSuccess = False
-                    break
+    def cancelBackups(self):
+        """Cancel the running backup tasks."""
+        self.runner.cancel()
+
+    def onBackupsDone(self, bSuccess: bool):
+        """Callback when all backup tasks are over."""
         self.updateTasks()
         self.setLoadingIcon(True)
         self.isRunning = False
@@ -121,10 +124,12 @@ class ModuleBackups(TabModule):
 
         # Buttons
         self.btnRun = self.addButton('Backup', 'run',  self.runBackups)
+        self.btnCancel = self.addButton('Annuler', 'cancel',  self.cancelBackups)
         self.btnRefresh = self.addButton('Recharger', 'refresh',  self.reloadTasks)
 
     def enableWidgets(self):
         self.btnRun.enableWidget(not self.isRunning)
+        self.btnCancel.enableWidget(self.isRunning)
         self.btnRefresh.enableWidget(not self.isRunning)
 
     def addButton(self, label: str, icon: str, cmd) -> Button:
@@ -201,23 +206,42 @@ class MountBackupDrive(PynorpaTask):
             self.cbkUpdate()
 
 class BackupPhotoDir(PynorpaTask):
-    """Backup a photo directory to external disk."""
+    """Backup the new or changed files of a photo directory to external disk.
+    The backup manifest and the files are read in run, once the drive is mounted."""
     log = logging.getLogger('BackupPhotoDir')
 
     def __init__(self, dir: str, cbkUpdate=None):
         self.dir = dir
+        self.backup = None
         super().__init__(f'Backup {dir}', f'Copier {dir} sur le disque externe', 1)
         self.cbkUpdate = cbkUpdate
 
     def prepare(self):
-        self.log.info('Prepare')
+        self.setDesc(f'Copier les fichiers nouveaux ou modifiés de {self.dir}')
 
     def run(self):
         super().run()
+        self.setDesc(f'Recherche des fichiers à copier dans {self.dir}')
+        self.cbkUpdate()
+        self.backup = PynorpaManager().getPhotoDirBackup(self.dir)
+        toCopy = self.backup.scan()
+        self.nStepsTotal = max(len(toCopy), 1)
+        self.tLastStep = time.time()
+        nBytes = sum(size for (_, size) in toCopy)
+        self.setDesc(f'{len(toCopy)} fichiers à copier ({TextTools.fileSizeToString(nBytes)}), '
+                     f'{self.backup.nFilesSkipped} à jour')
+        self.cbkUpdate()
+        if len(toCopy) == 0:
+            self.inc()
+        elif not self.backup.run(self.onProgress):
+            self.statusCode = TaskStatus.Error
+        self.setDesc(f'{self.backup.getReport()} {self.getRemainingTime()}')
+
+    def onProgress(self, relpath: str, bOk: bool):
+        if bOk:
+            self.inc()
+        self.setDesc(f'{self.backup.getProgress()} {self.getRemainingTime()}')
         self.cbkUpdate()
-        PynorpaManager().backupPhotoDir(self.dir)
-        self.inc()
-        self.setDesc(f'Copié {self.dir} {self.getRemainingTime()}')
 
 
 class TaskWidget:
@@ -51,6 +51,14 @@ class ModulePictures(TabModule):
         self.picture = picture
         self.enableWidgets()
 
+    def onRefresh(self):
+        """Merge database changes into caches and reload table."""
+        self.setLoadingIcon()
+        msg = PynorpaManager().refreshCaches()
+        self.loadData()
+        self.setLoadingIcon(True)
+        self.oParent.setStatus(msg)
+
     def onSavePicture(self, picture: Picture):
         """Save changes to edited object."""
         self.log.info('Saving %s', picture)
@@ -81,7 +89,7 @@ class ModulePictures(TabModule):
         self.btnReclass = BaseWidgets.Button(self.table.frmToolBar, 'Reclasser', self.onReclassify, 'edit')
         self.btnReclass.pack(0)
         self.searchBar = BaseWidgets.SearchBar(self.table.frmToolBar, 36, self.table.onSearch)
-        self.table.addRefreshButton(self.loadData)
+        self.table.addRefreshButton(self.onRefresh)
         self.factory.createWidgets(self.frmLeft)
         self.editor.createWidgets(self.frmRight)
         self.imageWidget.createWidgets(self.frmRight)
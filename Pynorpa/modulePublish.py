@@ -53,11 +53,15 @@ class ModulePublish(TabModule):
     def onUpload(self):
         """Upload HTML pages."""
         self.setLoadingIcon()
-        fDuration = self.uploader.uploadModified()
+        try:
+            fDuration = self.uploader.uploadModified()
+            self.isExported = False
+            status = f'Publié en {TextTools.durationToString(fDuration)}'
+        except uploader.UploadError as exc:
+            status = str(exc)
+            self.oParent.showErrorMsg(status)
         # TODO add progress bar
         self.setLoadingIcon(True)
-        self.isExported = False
-        status = f'Publié en {TextTools.durationToString(fDuration)}'
         self.lblStatus.configure(text=status)
         self.enableWidgets()
 
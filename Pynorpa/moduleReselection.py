@@ -19,6 +19,7 @@ from moduleSelection import TablePhotos, PhotoEditor, TaxonSelector
 from pynorpaManager import PynorpaManager, PynorpaException
 from PhotoInfo import *
 import imageWidget
+from ImageResizer import ImageResizer
 from MapWidget import MapWidget
 from ModalDialog import *
 from LatLonZoom import LatLonZoom
@@ -89,8 +90,7 @@ class ModuleReselection(TabModule):
         if photo is not None:
             thumbfile = photo.filename.replace('photos/', 'thumbs/')
             if not os.path.exists(thumbfile):
-                sCmd = f'convert {photo.filename} -resize 500x500 {thumbfile}'
-                os.system(sCmd)
+                ImageResizer().resize(photo.filename, [(thumbfile, ImageResizer.MEDIUM)])
         self.photo = photo
         self.imageWidget.loadData(thumbfile)
         self.editor.loadData(photo)
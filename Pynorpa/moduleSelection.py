@@ -66,9 +66,7 @@ class ModuleSelection(TabModule):
         self.photos = []
         metadata = self.loadMetadata()
         files = sorted(glob.glob(f'{self.dir}/*.JPG'))
-        for file in files:
-            photo = PhotoInfo(file)
-            photo.identify()
+        for photo in PhotoInfoIndex().identifyMany(files):
             if metadata and photo.getNameShort() in metadata['orig']:
                 idxLocClosest = metadata['orig'][photo.getNameShort()]['closeTo']
                 #self.log.info(f'Using metadata closeTo {idxLocClosest} for {photo.getNameShort()}')
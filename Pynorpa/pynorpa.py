@@ -13,6 +13,7 @@ import sys
 import logging
 import getopt
 from PynorpaApp import *
+from exporter import Exporter
 
 
 def configureLogging():
@@ -33,28 +34,32 @@ def configureLogging():
 
 def getOptions():
     """Parse program arguments and store them in a dict."""
-    dOptions = {'dryrun': False, 'upload': False}
+    dOptions = {'dryrun': False, 'upload': False, 'jobs': 1}
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "hdu", ["help", "dry", "upload"])
+        opts, args = getopt.getopt(sys.argv[1:], "hduj:", ["help", "dry", "upload", "jobs="])
     except getopt.GetoptError:
         print("Invalid options: %s", sys.argv[1:])
     for opt, arg in opts:
         log.info("Parsing option %s value %s", opt, arg)
         if opt in ('-h', '--help'):
-            print('pynorpa.py -h (help) -u (upload) -d (upload dry run)')
+            print('pynorpa.py -h (help) -u (upload) -d (upload dry run) -j N (export with N processes)')
             sys.exit()
         elif opt in ("-d", "--dry"):
             dOptions['dryrun'] = True
         elif opt in ("-u", "--upload"):
             dOptions['upload'] = True
+        elif opt in ("-j", "--jobs"):
+            dOptions['jobs'] = int(arg)
     return dOptions
 
 def main():
     """Main function. Builds or uploads depending on options."""
     log.info('Welcome to Pynorpa v' + __version__)
+    Exporter.nJobs = dOptions['jobs']
     app = PynorpaApp()
     app.run()
 
-log = configureLogging()
-dOptions = getOptions()
-main()
+if __name__ == '__main__':
+    log = configureLogging()
+    dOptions = getOptions()
+    main()
@@ -7,12 +7,14 @@ __copyright__ = "Copyright 2024 N. Zwahlen"
 __version__ = "1.0.1"
 
 import logging
+import re
 import DateTools
 from HtmlPage import *
 
 class PynorpaHtmlPage(HtmlPage):
     log = logging.getLogger('PynorpaHtmlPage')
     version = '0'
+    reVolatile = re.compile(r'<!-- Generated by pynorpa.py on [^>]* -->|Copyleft Nicolas Zwahlen &mdash; [0-9.]+')
 
     def __init__(self, sTitle, sPath = ''):
         self.sPath = sPath
@@ -45,6 +47,11 @@ class PynorpaHtmlPage(HtmlPage):
         footer.addTag(HtmlTag('p', f'Copyleft Nicolas Zwahlen &mdash; {date} &mdash; Pynorpa v{self.version}'))
         self.body.addTag(footer)
 
+    @classmethod
+    def removeVolatile(cls, html: str) -> str:
+        """Remove the generation date from a page HTML, to compare contents."""
+        return cls.reVolatile.sub('', html)
+
     def addOpenLayerHeaders(self):
         """Add scripts and CSS references for OpenLayer maps."""
         self.includeScript('js/OpenLayers-v5.3.0.js')
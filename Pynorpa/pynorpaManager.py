@@ -13,7 +13,9 @@ from tkinter import messagebox as mb
 import DateTools
 import TextTools
 
+from DirBackup import DirBackup
 from GeoTracker import GeoTrack
+from ImageResizer import ImageResizer
 from LocationCache import Location, LocationCache
 from PhotoInfo import PhotoInfo
 from picture import Picture, PictureCache
@@ -52,6 +54,16 @@ class PynorpaManager():
         self.locationCache = LocationCache()
         self.expeditionCache = ExpeditionCache()
 
+    def refreshCaches(self) -> str:
+        """Merge the database changes made by other tools into the caches.
+        Return a status message."""
+        stats = self.pictureCache.refresh()
+        self.expeditionCache.relinkPictures()
+        msg = (f"Photos : {stats['new']} nouvelles, {stats['modified']} modifiées, {stats['deleted']} effacées, "
+               f"{stats['taxa']} nouveaux taxons, {stats['locations']} nouveaux lieux en {stats['time']:.3f}s")
+        self.log.info(msg)
+        return msg
+
     def addPicture(self, filename: str, loc: Location) -> Picture:
         """Add a new Picture to gallery."""
         self.log.info('Adding picture %s at %s', filename, loc)
@@ -115,8 +127,8 @@ class PynorpaManager():
         # Copy files to gallery
         dryrun = False
         self.runSystemCommand(f'cp {filename} {dest}', dryrun)
-        self.runSystemCommand(f'convert {filename} -resize 500x500 {config.dirPicsBase}medium/{basename}', dryrun)
-        self.runSystemCommand(f'convert {filename} -resize 180x180 {config.dirPicsBase}thumbs/{basename}', dryrun)
+        ImageResizer().resize(filename, [(f'{config.dirPicsBase}medium/{basename}', ImageResizer.MEDIUM),
+                                         (f'{config.dirPicsBase}thumbs/{basename}', ImageResizer.THUMB)])
 
         # Save to DB
         self.pictureCache.save(pic)
@@ -188,6 +200,7 @@ class PynorpaManager():
         exporter = Exporter()
         exporter.initCaches()
         exporter.buildExcursions()
+        exporter.deps.save()
 
         # Upload
         uploader = Uploader()
@@ -257,22 +270,29 @@ class PynorpaManager():
         self.saveINatTaxa(taxa)
         
     def saveINatTaxa(self, taxa: list[Taxon], cbkStatus=None):
-        """Save new taxa to DB"""
-        iNewTaxa = 0
+        """Save new taxa to DB. Each taxon of the list is the parent of the next one,
+        the taxa whose parent is saved are inserted together."""
         parent = None
-        idxParent = None
+        pending = []
         for taxon in taxa:
             if taxon.idx < 0:
-                if taxon.idxParent < 0:
-                    taxon.idxParent = idxParent
-                if taxon.parent is None and parent is not None and parent.idx == idxParent:
+                if taxon.parent is None and parent is not None and (taxon.idxParent < 0 or parent.idx == taxon.idxParent):
                     taxon.parent = parent
-                self.log.info(f'Will save {taxon}')
-                self.taxonCache.insert(taxon)
-                self.log.info(f'Saved {taxon}')
-                iNewTaxa += 1
-            idxParent = taxon.idx
+                pending.append(taxon)
             parent = taxon
+        iNewTaxa = len(pending)
+        with self.taxonCache.transaction():
+            while pending:
+                ready = [t for t in pending if t.idxParent > 0 or t.parent is None or t.parent.idx > 0]
+                for t in ready:
+                    if t.idxParent < 0:
+                        t.idxParent = t.parent.idx if t.parent else None
+                    self.log.info(f'Will save {t}')
+                self.taxonCache.insertMany(ready)
+                if not ready or any(t.idx < 0 for t in ready):
+                    raise PynorpaException(f'Echec de création des taxons')
+                pending = [t for t in pending if t.idx < 0]
+        self.log.info('Connection pool: %s', self.taxonCache.db.getPoolStats())
         msg = f'Créé {iNewTaxa} nouveaux taxons.'
         if cbkStatus:
             cbkStatus(msg)
@@ -317,8 +337,8 @@ class PynorpaManager():
         self.runSystemCommand(f'mv {config.dirPicsBase}thumbs/{oldName} {config.dirPicsBase}thumbs/{newName}', dryrun)
 
         # Update old and new taxon pictures in cache
-        picture.getTaxon().getPictures().remove(picture)
-        newTaxon.pictures.append(picture)
+        picture.getTaxon().removePicture(picture)
+        newTaxon.addPicture(picture)
     
         # Update picture name and taxon in DB
         picture.setFilename(newName)
@@ -336,7 +356,7 @@ class PynorpaManager():
         self.runSystemCommand(f'rm {config.dirPictures}{pic.getFilename()}', dryrun)
         self.runSystemCommand(f'rm {config.dirPicsBase}medium/{pic.getFilename()}', dryrun)
         self.runSystemCommand(f'rm {config.dirPicsBase}thumbs/{pic.getFilename()}', dryrun)      
-        pic.getTaxon().getPictures().remove(pic)
+        pic.getTaxon().removePicture(pic)
         pic.getLocation().getPictures().remove(pic)
         self.pictureCache.delete(pic, dryrun)
 
@@ -404,23 +424,18 @@ class PynorpaManager():
 
         result = []
         pathLocal = f'{config.dirPhotosBase}'
-        pathExtnl = f'{config.dirElements}Pictures/'
         dirsLocal = sorted(glob.glob(f'{pathLocal}Nature-2*'))
         for dir in dirsLocal[:len(dirsLocal)-1]:
             dirBaseName = os.path.basename(dir)
-            dirExtnl = f'{pathExtnl}{dirBaseName}'
-            if not os.path.exists(dirExtnl):
+            if self.getPhotoDirBackup(dirBaseName).needsBackup():
                 self.log.info(f'Local dir {dirBaseName} needs backup')
                 result.append(dirBaseName)
         return result
-    
-    def backupPhotoDir(self, dir: str):
-        """Copy a photo dir to external backup disk."""
-        self.log.info(f'Backing up {dir}, may take a while...')
-        cmd = f'cp -r {config.dirPhotosBase}{dir} {config.dirElements}Pictures/'
-        self.runSystemCommand(cmd)
-        self.log.info(f'Backup of  {dir} done')
-    
+
+    def getPhotoDirBackup(self, dir: str) -> DirBackup:
+        """Get the incremental backup of a photo dir to external backup disk."""
+        return DirBackup(f'{config.dirPhotosBase}{dir}', f'{config.dirElements}Pictures/{dir}')
+
     def runSystemCommand(self, cmd: str, dryrun=False):
         """Run a system command."""
         if dryrun:
@@ -5,12 +5,14 @@ __copyright__ = "Copyright 2024 N. Zwahlen"
 __version__ = "1.0.0"
 
 import config
+from contextlib import contextmanager
 from enum import Enum
 import logging
 
 import Database
 import TextTools
 from iNatApiRequest import INatTaxon
+from Timer import Timer
 
 
 class TaxonRank(Enum):
@@ -57,9 +59,40 @@ class TaxonRank(Enum):
     def __str__(self):
         return self.name
     
+class TaxonAggregates:
+    """Totals of a taxon and its subtree, computed from the aggregates of its children."""
+
+    def __init__(self, taxon: 'Taxon', children: list['TaxonAggregates']):
+        """Constructor from the taxon and the aggregates of its children."""
+        self.nAllPictures = len(taxon.pictures) + sum(child.nAllPictures for child in children)
+        self.nSpecies = sum(child.nSpecies for child in children)
+        if taxon.rank == TaxonRank.SPECIES and len(taxon.pictures) > 0:
+            self.nSpecies += 1
+        aShotAt = [pic.shotAt for pic in taxon.pictures if pic.shotAt is not None]
+        aShotAt += [child.latestShotAt for child in children if child.latestShotAt is not None]
+        self.latestShotAt = max(aShotAt) if len(aShotAt) > 0 else None
+
+        # Same choices as the recursive search: own pictures, then typical child, then first child
+        if len(taxon.pictures) > 0:
+            self.anyPicture = taxon.pictures[0]
+        elif len(children) > 0:
+            self.anyPicture = children[0].anyPicture
+        else:
+            self.anyPicture = None
+        if len(taxon.pictures) > 0:
+            self.typicalPicture = taxon.getBestPicture()
+        else:
+            typicalChild = taxon.getTypicalChild()
+            if typicalChild:
+                self.typicalPicture = children[taxon.children.index(typicalChild)].typicalPicture
+            else:
+                self.typicalPicture = self.anyPicture
+
+
 class Taxon():
     """Class Taxon"""
     log = logging.getLogger("Taxon")
+    bMemoize = True
 
     def __init__(self, idx: int, name: str, nameFr: str, rank: str, idxParent: int, order: int, typical: bool):
         """Constructor."""
@@ -75,16 +108,39 @@ class Taxon():
         self.parent = None
         self.children = []
         self.pictures = []
+        self.aggregates = None
 
     def addChild(self, child: 'Taxon'):
         """Add a child of this taxon."""
         if child is not None:
             self.children.append(child)
+            self.invalidateAggregates()
 
     def addPicture(self, picture):
         """Add a picture of this taxon."""
         if picture:
             self.pictures.append(picture)
+            self.invalidateAggregates()
+
+    def removePicture(self, picture):
+        """Remove a picture of this taxon, if present."""
+        if picture in self.pictures:
+            self.pictures.remove(picture)
+            self.invalidateAggregates()
+
+    def getAggregates(self) -> TaxonAggregates:
+        """Get the totals of this taxon and its subtree, computed bottom-up on first use."""
+        if self.aggregates is None or not self.bMemoize:
+            self.aggregates = TaxonAggregates(self, [child.getAggregates() for child in self.children])
+        return self.aggregates
+
+    def invalidateAggregates(self):
+        """Forget the aggregates of this taxon and its ancestors, after a change in its subtree.
+        A computed taxon has all its descendants computed, so the walk stops at the first one not computed."""
+        taxon = self
+        while taxon is not None and taxon.aggregates is not None:
+            taxon.aggregates = None
+            taxon = taxon.parent
 
     def getChildren(self) -> list['Taxon']:
         """Get all children of this taxon."""
@@ -101,11 +157,7 @@ class Taxon():
     
     def getAnyPicture(self):
         """Get any picture of this taxon or its children."""
-        if len(self.pictures) > 0:
-            return self.pictures[0]
-        if len(self.children) > 0:
-            return self.getChildren()[0].getAnyPicture()
-        return None
+        return self.getAggregates().anyPicture
     
     def getBestPicture(self):
         """Get the highest quality picture of this taxon."""
@@ -119,19 +171,19 @@ class Taxon():
     
     def getTypicalPicture(self):
         """Get the most representative picture of this taxon or its children."""
-        if len(self.pictures) > 0:
-            return self.getBestPicture()
-        typicalChild = self.getTypicalChild()
-        if typicalChild:
-            return typicalChild.getTypicalPicture()
-        return self.getAnyPicture()
+        return self.getAggregates().typicalPicture
     
     def countAllPictures(self) -> int:
         """Count all pictures of this taxon and its children."""
-        count = len(self.pictures)
-        for child in self.getChildren():
-            count += child.countAllPictures()
-        return count
+        return self.getAggregates().nAllPictures
+
+    def countAllSpecies(self) -> int:
+        """Count the species with pictures in this taxon and its children."""
+        return self.getAggregates().nSpecies
+
+    def getLatestShotAt(self):
+        """Get the latest shot-at datetime of the pictures of this taxon and its children, or None."""
+        return self.getAggregates().latestShotAt
     
     def getPictures(self) -> list:
         """Return the pictures of this taxon, excluding children."""
@@ -219,6 +271,8 @@ class Taxon():
     def setTypical(self, typical: bool):
         """Setter for typical"""
         self.typical = typical
+        if self.parent:
+            self.parent.invalidateAggregates()
 
     def getAncestor(self, rank: TaxonRank) -> 'Taxon':
         """Get our ancestor at the specified rank."""
@@ -269,23 +323,43 @@ class TaxonCache():
         self.db = Database.Database(config.dbName)
         self.topLevel = []
         self.dictById = {}
+        self.maxIdx = 0
+        self.pendingTaxa = None
+        taxa = self.fetchTaxa('1=1')
+        self.log.info(f'Fetched {len(self.dictById)} taxa from DB')
+        self.linkTaxa(taxa)
+
+    def refresh(self) -> int:
+        """Fetch the taxa inserted since the last load, using the max idx as watermark.
+        Return the number of new taxa."""
+        taxa = self.fetchTaxa('idxTaxon > %s', (self.maxIdx,))
+        self.linkTaxa(taxa)
+        self.log.info(f'Refreshed {len(taxa)} new taxa from DB')
+        return len(taxa)
+
+    def fetchTaxa(self, where: str, params=None) -> list[Taxon]:
+        """Fetch Taxon records from a where-clause and add them to cache."""
+        taxa = []
         self.db.connect(config.dbUser, config.dbPass)
         query = Database.Query('Taxon')
         query.add('select idxTaxon, taxName, taxNameFr, taxRank, taxParent, taxOrder, taxTypical')
-        query.add('from Taxon order by taxOrder asc, taxName asc')
-        rows = self.db.fetch(query.getSQL())
+        query.add(f'from Taxon where {where} order by taxOrder asc, taxName asc')
+        rows = self.db.fetch(query.getSQL(), params)
         for row in rows:
             taxon = Taxon(*row)
             self.dictById[taxon.getIdx()] = taxon
+            self.maxIdx = max(self.maxIdx, taxon.getIdx())
             if taxon.isTopLevel():
                 self.topLevel.append(taxon)
+            taxa.append(taxon)
         query.close()
         self.db.disconnect()
-        self.log.info(f'Fetched {len(self.dictById)} taxa from DB')
+        return taxa
 
-        # Add children to their parents
+    def linkTaxa(self, taxa: list[Taxon]):
+        """Add the specified taxa as children of their parents."""
         taxon: Taxon
-        for taxon in self.dictById.values():
+        for taxon in taxa:
             if taxon.idxParent is not None:
                 parent = self.findById(taxon.idxParent)
                 if parent is not None:
@@ -294,6 +368,30 @@ class TaxonCache():
                 else:
                     self.log.error('Could not find parent of %s', taxon)
 
+    @contextmanager
+    def transaction(self):
+        """Context to group several writes into a single database commit.
+        The taxa inserted meanwhile are added to the cache after the commit,
+        and get back an idx of -1 if it is rolled back."""
+        bOuter = self.pendingTaxa is None
+        if bOuter:
+            self.pendingTaxa = []
+        try:
+            with self.db.transaction(config.dbUser, config.dbPass) as db:
+                yield db
+        except Exception:
+            if bOuter:
+                for taxon in self.pendingTaxa:
+                    taxon.idx = -1
+                self.log.info('Discarded %d taxa of rolled back transaction', len(self.pendingTaxa))
+            raise
+        finally:
+            if bOuter:
+                (pendingTaxa, self.pendingTaxa) = (self.pendingTaxa, None)
+        if bOuter:
+            for taxon in pendingTaxa:
+                self.addToCache(taxon)
+
     def save(self, obj: Taxon):
         """Insert or update the specified Taxon in database."""
         if obj is None:
@@ -321,34 +419,72 @@ class TaxonCache():
         self.db.disconnect()
         query.close()
 
-    def insert(self, obj: Taxon):
-        """Insert the specified Taxon in database."""
-        self.log.info('Inserting %s', obj)
-        query = Database.Query('Insert Taxon')
+    def getInsertQuery(self, obj: Taxon) -> Database.Query:
+        """Build the parameterized insert query for the specified Taxon."""
+        query = Database.Query('Insert Taxon', True)
         query.add('Insert into Taxon (idxTaxon, taxName, taxNameFr, taxRank, taxParent, taxOrder, taxTypical)')
         query.add('values (null')
         query.add(',').addEscapedString(obj.getName())
         query.add(',').addEscapedString(obj.getNameFr())
         query.add(',').addEscapedString(obj.getRank().name)
         query.add(',').addNullableFK(obj.getIdxParent())
-        query.add(f', {obj.getOrder()}')
+        query.add(',').addParam(obj.getOrder())
         query.add(',').addBool(obj.getTypical())
         query.add(')')
+        return query
+
+    def insert(self, obj: Taxon):
+        """Insert the specified Taxon in database."""
+        self.log.info('Inserting %s', obj)
+        query = self.getInsertQuery(obj)
         self.db.connect(config.dbUser, config.dbPass)
-        idx = self.db.execute(query.getSQL())
+        idx = self.db.execute(query.getSQL(), query.getParams())
         self.db.disconnect()
         query.close()
         if idx:
             self.log.info(f'Inserted with idx {idx}')
             obj.idx = idx
-            self.dictById[obj.getIdx()] = obj
-            if obj.parent is not None:
-                obj.parent.addChild(obj)
-            else:
-                self.log.warning(f'No parent for {obj}')
+            self.addToCache(obj)
         else:
             self.log.error('No idx after insertion!')
 
+    def insertMany(self, taxa: list[Taxon], chunkSize=500):
+        """Insert the specified Taxa in database, one round trip per chunk.
+        Parents must already be saved, so a new hierarchy needs one call per rank."""
+        if not taxa:
+            return
+        self.log.info('Inserting %d taxa', len(taxa))
+        sql = None
+        rows = []
+        for taxon in taxa:
+            query = self.getInsertQuery(taxon)
+            sql = query.getSQL()
+            rows.append(query.getParams())
+            query.close()
+        self.db.connect(config.dbUser, config.dbPass)
+        ids = self.db.executeMany(sql, rows, chunkSize)
+        self.db.disconnect()
+        if ids and len(ids) == len(taxa):
+            for (taxon, idx) in zip(taxa, ids):
+                taxon.idx = idx
+                self.addToCache(taxon)
+            self.log.info(f'Inserted with idx {ids[0]} to {ids[-1]}')
+        else:
+            self.log.error('No idx after insertion!')
+
+    def addToCache(self, obj: Taxon):
+        """Add a newly inserted Taxon to cache and to its parent,
+        once the running transaction is committed."""
+        if self.pendingTaxa is not None:
+            self.pendingTaxa.append(obj)
+            return
+        self.dictById[obj.getIdx()] = obj
+        self.maxIdx = max(self.maxIdx, obj.getIdx())
+        if obj.parent is not None:
+            obj.parent.addChild(obj)
+        else:
+            self.log.warning(f'No parent for {obj}')
+
     def delete(self, taxon: Taxon, dryrun=True):
         """Delete the specified Taxon from database."""
         self.log.info('Deleting %s', taxon)
@@ -390,6 +526,17 @@ class TaxonCache():
         self.db.disconnect()
         return result
 
+    def getTaxa(self) -> list[Taxon]:
+        """Return all taxa in cache."""
+        return list(self.dictById.values())
+
+    def computeAggregates(self):
+        """Compute the picture totals of all taxa in one bottom-up pass."""
+        timer = Timer()
+        for taxon in self.topLevel:
+            taxon.getAggregates()
+        self.log.info(f'Computed aggregates of {len(self.dictById)} taxa in {timer.getElapsed()}')
+
     def getTopLevelTaxa(self) -> list[Taxon]:
         """Get all taxa without parent."""
         return self.topLevel
@@ -5,8 +5,14 @@ to www.tf79.ch using FTP.
 
 import config
 import ftplib
+import hashlib
+import json
 import logging
 import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from appParam import AppParamCache
 from LocationCache import Location
@@ -15,16 +21,43 @@ from taxon import Taxon, TaxonRank
 from expedition import Expedition
 from Timer import *
 
+class UploadError(Exception):
+    """Raised when some files could not be uploaded."""
+    pass
+
 class Uploader:
-    """Upload files to website using FTP."""
+    """Upload files to website using a pool of FTP sessions.
+    A local manifest of the uploaded sizes and hashes avoids sending unchanged files."""
     log = logging.getLogger('Uploader')
+    nSessions = 4
+    nRetries = 4
+    backoff = 1.0
+    maxConnectFailures = 3
+    ftpPort = 21
+    ftpDir = 'httpdocs/nature/'
+    transientErrors = (ftplib.error_temp, ftplib.error_reply, EOFError, OSError)
+    unreachableErrors = (ConnectionRefusedError, socket.gaierror)
 
-    def __init__(self, bDryRun=False) -> None:
-        self.oSession = None
+    def __init__(self, bDryRun=False, apCache: AppParamCache = None) -> None:
         self.bDryRun = bDryRun
         self.log.info(f'Dry-run: {bDryRun}')
-        self.apCache = AppParamCache()
+        self.apCache = apCache
         self.picCache = None
+        self.ftpAddress = config.ftpAddress
+        self.ftpUser = config.ftpUser
+        self.ftpPassword = config.ftpPassword
+        self.local = threading.local()
+        self.sessions = []
+        self.lock = threading.Lock()
+        self.manifestFile = f'{config.dirWebExport}pynorpa-ftp.json'
+        self.manifest = None
+        self.resetStats()
+
+    def getAppParamCache(self) -> AppParamCache:
+        """Get the app params, loaded from the database on first use."""
+        if self.apCache is None:
+            self.apCache = AppParamCache()
+        return self.apCache
 
     def countModified(self) -> int:
         """Returns the number of pics to upload."""
@@ -33,11 +66,25 @@ class Uploader:
         return len(picsModified)
 
     def uploadModified(self):
-        """Upload modified pictures and their pages."""
+        """Upload modified pictures and their pages. The last upload date only moves forward
+        if all files were sent, otherwise raises UploadError so that they are offered again."""
         self.log.info('Uploading modified pictures and pages')
         oTimer = Timer()
         self.connect()
 
+        # Send them all through the pool of sessions
+        self.uploadFiles(self.getModifiedFiles(), 'modified')
+        self.quit()
+        if not self.isSuccessful():
+            self.log.error('Upload of modifs failed, last upload date unchanged: %s', self.getReport())
+            raise UploadError(f'Upload incomplet : {self.getReport()}')
+        self.getAppParamCache().setLastUploadAt()
+        self.log.info('Done uploading modifs in %s', oTimer.getElapsed())
+        return oTimer.getElapsedSeconds()
+
+    def getModifiedFiles(self) -> list[tuple[str, str]]:
+        """Get the (filename, ftp dir) pairs of the pictures modified since the last upload,
+        and of the pages showing them."""
         # Fetch pics, taxa and locations to upload
         self.picCache = PictureCache()
         picsModified = self.picCache.fetchPicsToUpload()
@@ -55,47 +102,35 @@ class Uploader:
                 locsModified.add(loc)
         self.log.info(f'Fetched {len(picsModified)} pictures in {len(taxaModified)} taxa and {len(locsModified)} locations')
 
-        # Upload pics, medium, thumbs
-        self.uploadPhotos(picsModified, config.dirPictures, 'photos/')
-        self.uploadPhotos(picsModified, f'{config.dirPicsBase}medium/', 'medium/')
-        self.uploadPhotos(picsModified, f'{config.dirPicsBase}thumbs/', 'thumbs/')
+        # Pics, medium, thumbs
+        files = []
+        for (localDir, ftpDir) in [(config.dirPictures, 'photos/'), 
+                                   (f'{config.dirPicsBase}medium/', 'medium/'),
+                                   (f'{config.dirPicsBase}thumbs/', 'thumbs/')]:
+            for pic in picsModified:
+                filename = f'{localDir}{pic.filename}'
+                if self.checkFileExists(filename):
+                    files.append((filename, ftpDir))
 
-        # Upload taxon pages if they exist
-        taxaBase  = []
-        taxaPages = []
+        # Taxon pages if they exist
         for taxon in taxaModified:
             filename = self.getTaxonPage(taxon)
             if filename:
                 self.log.debug(f'Will upload page for {taxon}')
                 dir = self.getTaxonDir(taxon)
-                if dir is None:
-                    taxaBase.append(f'{config.dirWebExport}{filename}')
-                else:
-                    taxaPages.append(f'{config.dirWebExport}{dir}{filename}')
-        self.uploadMulti(taxaBase,  'base taxa')
-        self.uploadMulti(taxaPages, 'page taxa', 'pages/')
-
-        # Upload modified locations
-        locFiles = []
+                files.append((f'{config.dirWebExport}{"" if dir is None else dir}{filename}', dir))
+
+        # Modified locations
         loc: Location
         for loc in locsModified:
-            filename = f'{config.dirWebExport}lieu{loc.getIdx()}.html'
-            locFiles.append(filename)
-        self.uploadMulti(locFiles, 'location')
+            files.append((f'{config.dirWebExport}lieu{loc.getIdx()}.html', None))
 
-        # Upload index and other base html pages
-        htmlFiles = []
+        # Index and other base html pages
         homePages = ['index', 'classification', 'latest', 'locations', 'noms-latins', 'noms-verna', 'expeditions', 'liens']
         for page in homePages:
-            filename = f'{config.dirWebExport}{page}.html'
-            htmlFiles.append(filename)
-        self.uploadMulti(htmlFiles, 'home')
-        self.upload(f'{config.dirWebExport}taxa.json')
-
-        self.quit()
-        self.apCache.setLastUploadAt()
-        self.log.info('Done uploading modifs in %s', oTimer.getElapsed())
-        return oTimer.getElapsedSeconds()
+            files.append((f'{config.dirWebExport}{page}.html', None))
+        files.append((f'{config.dirWebExport}taxa.json', None))
+        return files
 
     def uploadSinglePhoto(self, pic: Picture):
         """Upload a single picture file."""
@@ -137,46 +172,172 @@ class Uploader:
         self.upload(filename)
         self.quit()
 
-    def uploadPhotos(self, pics: list[Picture], localDir: str, ftpDir: str):
-        """Upload the photo/medium/thumbs JPG files."""
-        self.log.info(f'Uploading {len(pics)} pics from {localDir} to {ftpDir}')
-        files = []
-        for pic in pics:
-            filename = f'{localDir}{pic.filename}'
-            if self.checkFileExists(filename):
-                files.append(filename)
-        self.uploadMulti(files, 'pics', ftpDir)
-
     def upload(self, filename: str, dir=None):
         """Upload the specified file to FTP."""
-        if self.bDryRun:
-            self.log.info(f'dry-run upload {filename} to {dir}')
-            return
-        if self.oSession:
-            self.log.info('Uploading %s', filename)
-            if dir:
-                self.oSession.cwd(dir)
-                self.log.info(f'Now in ftp:{self.oSession.pwd()}')
-            with open(filename, 'rb') as file:
-                self.oSession.storbinary('STOR ' + os.path.basename(filename), file)
-            if dir:
-                self.oSession.cwd('..')
-                self.log.info(f'Now in ftp:{self.oSession.pwd()}')
+        self.uploadFiles([(filename, dir)], 'single')
 
     def uploadMulti(self, files: list[str], kind: str, dir=None):
         """Upload multiple files to the same FTP dir."""
+        self.uploadFiles([(filename, dir) for filename in files], kind)
+
+    def uploadFiles(self, files: list[tuple[str, str]], kind: str):
+        """Upload (filename, ftp dir) pairs concurrently, skipping files 
+        whose size and hash match the manifest."""
         sDryRun = '[dryrun] ' if self.bDryRun else ''
-        self.log.info(f'{sDryRun}Uploading {len(files)} {kind} files to {dir}')
-        if self.oSession:
-            if dir:
-                self.oSession.cwd(dir)
-                self.log.debug(f'Now in ftp:{self.oSession.pwd()}')
-            for filename in files:
+        self.log.info(f'{sDryRun}Uploading {len(files)} {kind} files with {self.nSessions} sessions')
+        timer = Timer()
+        self.loadManifest()
+        try:
+            with ThreadPoolExecutor(max_workers=self.nSessions) as executor:
+                for _ in executor.map(lambda pair: self.sendIfModified(*pair), files):
+                    pass
+        finally:
+            self.saveManifest()
+            self.quit()
+        self.stats['seconds'] += timer.getElapsedSeconds()
+        self.log.info(f'{sDryRun}Uploaded {kind} files: {self.getReport()}')
+
+    def sendIfModified(self, filename: str, dir=None) -> bool:
+        """Upload a file unless the manifest shows the same size and hash on the server."""
+        remote = f'{"" if dir is None else dir}{os.path.basename(filename)}'
+        if not self.checkFileExists(filename):
+            with self.lock:
+                self.stats['failed'] += 1
+            return False
+        (size, sha1) = self.getFileKey(filename)
+        with self.lock:
+            entry = self.manifest.get(remote)
+        if entry and entry['size'] == size and entry['sha1'] == sha1:
+            with self.lock:
+                self.stats['skipped'] += 1
+            return True
+        if self.bDryRun:
+            self.log.info(f'dry-run upload {filename} to {remote}')
+            return True
+        if not self.bUnreachable and self.sendFile(filename, remote):
+            with self.lock:
+                self.manifest[remote] = {'size': size, 'sha1': sha1}
+                self.stats['sent'] += 1
+            return True
+        with self.lock:
+            self.stats['failed'] += 1
+        return False
+
+    def sendFile(self, filename: str, remote: str, resume=False) -> bool:
+        """Store a file on the server, relative to the base FTP dir. Transient errors
+        are retried with an exponential backoff, resuming from the bytes this transfer
+        sent and the server kept. With resume, a partial file already on the server
+        is continued if its content matches the start of the local file.
+        Gives up at once when the server is unreachable."""
+        size = os.path.getsize(filename)
+        nSent = 0
+        for attempt in range(self.nRetries + 1):
+            if self.bUnreachable:
+                self.log.error(f'Not uploading {filename}, FTP server {self.ftpAddress} unreachable')
+                return False
+            try:
+                session = self.getSession()
+                offset = 0
+                if attempt > 0 or resume:
+                    remoteSize = self.getRemoteSize(session, remote)
+                    if remoteSize is not None and remoteSize < size:
+                        if remoteSize <= nSent or (attempt == 0 and self.checkRemotePrefix(session, filename, remote, remoteSize)):
+                            offset = remoteSize
+                self.log.debug(f'Storing {filename} as {remote} from {offset}')
+                nSent = offset
+                def onBlock(block):
+                    nonlocal nSent
+                    nSent += len(block)
                 with open(filename, 'rb') as file:
-                    self.oSession.storbinary('STOR ' + os.path.basename(filename), file)
-            if dir:
-                self.oSession.cwd('..')
-                self.log.debug(f'Now in ftp:{self.oSession.pwd()}')
+                    file.seek(offset)
+                    session.storbinary(f'STOR {remote}', file, callback=onBlock, rest=offset if offset > 0 else None)
+                with self.lock:
+                    self.stats['bytes'] += size - offset
+                    if offset > 0:
+                        self.stats['resumed'] += 1
+                return True
+            except ftplib.error_perm as e:
+                self.log.error(f'Failed to upload {filename}: {e}')
+                return False
+            except self.transientErrors as e:
+                self.dropSession()
+                if self.bUnreachable:
+                    continue
+                delay = self.backoff * 2**attempt
+                self.log.warning(f'Upload of {filename} failed ({e}), retry {attempt+1} in {delay:.1f}s')
+                with self.lock:
+                    self.stats['retries'] += 1
+                time.sleep(delay)
+        self.log.error(f'Giving up upload of {filename} after {self.nRetries} retries')
+        return False
+
+    def getRemoteSize(self, session: ftplib.FTP, remote: str) -> int:
+        """Get the size of a remote file, or None if it does not exist."""
+        try:
+            return session.size(remote)
+        except ftplib.error_perm:
+            return None
+
+    def checkRemotePrefix(self, session: ftplib.FTP, filename: str, remote: str, size: int) -> bool:
+        """Check that the first size bytes of a remote file are those of the local file, by downloading them."""
+        remoteSha = hashlib.sha1()
+        nRead = 0
+        def onBlock(block):
+            nonlocal nRead
+            block = block[:size - nRead]
+            nRead += len(block)
+            remoteSha.update(block)
+        session.retrbinary(f'RETR {remote}', onBlock)
+        localSha = hashlib.sha1()
+        with open(filename, 'rb') as file:
+            localSha.update(file.read(size))
+        bSame = nRead == size and remoteSha.digest() == localSha.digest()
+        if not bSame:
+            self.log.warning(f'Remote {remote} does not match the start of {filename}, uploading it all')
+        return bSame
+
+    def getFileKey(self, filename: str) -> tuple[int, str]:
+        """Get the size and SHA-1 hash of a local file."""
+        sha = hashlib.sha1()
+        with open(filename, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                sha.update(block)
+        return (os.path.getsize(filename), sha.hexdigest())
+
+    def loadManifest(self):
+        """Load the sizes and hashes of the files already on the server."""
+        if self.manifest is not None:
+            return
+        self.manifest = {}
+        if os.path.exists(self.manifestFile):
+            with open(self.manifestFile, 'r') as file:
+                self.manifest = json.load(file)
+        self.log.info(f'Loaded manifest of {len(self.manifest)} uploaded files')
+
+    def saveManifest(self):
+        """Save the manifest, also after an interrupted upload."""
+        if self.manifest is not None and not self.bDryRun:
+            with self.lock:
+                with open(self.manifestFile, 'w') as file:
+                    json.dump(self.manifest, file)
+
+    def resetStats(self):
+        """Reset the upload counters and the unreachable server state."""
+        self.nConnectFailures = 0
+        self.bUnreachable = False
+        self.stats = {'sent': 0, 'skipped': 0, 'failed': 0, 'resumed': 0, 'retries': 0, 'bytes': 0, 'seconds': 0.0}
+
+    def isSuccessful(self) -> bool:
+        """Check that the server was reachable and no file failed since connect."""
+        return not self.bUnreachable and self.stats['failed'] == 0
+
+    def getReport(self) -> str:
+        """Get a report of sent bytes, files and throughput."""
+        stats = self.stats
+        speed = stats['bytes'] / stats['seconds'] / 1e6 if stats['seconds'] > 0 else 0.0
+        return (f"{stats['sent']} sent, {stats['skipped']} skipped, {stats['failed']} failed, "
+                f"{stats['resumed']} resumed, {stats['retries']} retries, "
+                f"{stats['bytes']/1e6:.2f} MB in {stats['seconds']:.3f}s at {speed:.2f} MB/s")
 
     def checkFileExists(self, filename: str) -> bool:
         """Return False if file does not exist."""
@@ -187,22 +348,66 @@ class Uploader:
             return False
 
     def connect(self):
-        """Connect to FTP server."""
-        if not self.bDryRun:
-            self.log.info('Connecting to FTP %s as %s', config.ftpAddress, config.ftpUser)
+        """Prepare uploads: sessions are opened when needed by each upload thread."""
+        self.resetStats()
+
+    def openSession(self) -> ftplib.FTP:
+        """Open an FTP session in the base dir."""
+        self.log.info('Connecting to FTP %s as %s', self.ftpAddress, self.ftpUser)
+        session = ftplib.FTP()
+        session.connect(self.ftpAddress, self.ftpPort)
+        session.login(self.ftpUser, self.ftpPassword)
+        self.log.info('Connected to FTP: %s', session.getwelcome())
+        session.cwd(self.ftpDir)
+        session.voidcmd('TYPE I')
+        return session
+
+    def getSession(self) -> ftplib.FTP:
+        """Get the FTP session of the current thread, opening it if needed."""
+        session = getattr(self.local, 'session', None)
+        if session is None:
             try:
-                self.oSession = ftplib.FTP(config.ftpAddress, config.ftpUser, config.ftpPassword)
-                self.log.info('Connected to FTP: %s', self.oSession.getwelcome())
-                self.oSession.cwd('httpdocs/nature/')
-            except ftplib.error_perm:
-                self.log.error('Failed to connect or cwd')
-                self.quit()
+                session = self.openSession()
+            except self.transientErrors as e:
+                self.onConnectFailed(e)
+                raise
+            self.local.session = session
+            with self.lock:
+                self.nConnectFailures = 0
+                self.sessions.append(session)
+        return session
+
+    def onConnectFailed(self, e: Exception):
+        """Count a failed connection, the server is unreachable when it refuses connections,
+        its name is unknown or maxConnectFailures connections failed in a row."""
+        with self.lock:
+            self.nConnectFailures += 1
+            if not self.bUnreachable and (isinstance(e, self.unreachableErrors) or self.nConnectFailures >= self.maxConnectFailures):
+                self.bUnreachable = True
+                self.log.error(f'FTP server {self.ftpAddress} unreachable ({e}), giving up the uploads')
+
+    def dropSession(self):
+        """Close the FTP session of the current thread after an error."""
+        session = getattr(self.local, 'session', None)
+        self.local.session = None
+        if session is not None:
+            with self.lock:
+                self.sessions.remove(session)
+            session.close()
 
     def quit(self):
-        """Close the connection if it is still open."""
-        if self.oSession:
-            self.log.info('Closing FTP connection')
-            self.oSession.close()
+        """Close the connections that are still open."""
+        with self.lock:
+            sessions = self.sessions
+            self.sessions = []
+        if sessions:
+            self.log.info(f'Closing {len(sessions)} FTP connections')
+        for session in sessions:
+            try:
+                session.quit()
+            except self.transientErrors:
+                session.close()
+        self.local = threading.local()
     
     def getModifiedAt(self, sFile):
         return os.path.getmtime(sFile)
@@ -234,3 +439,123 @@ class Uploader:
                 return 'pages/'
             case _:
                 return None
+
+
+def testUploader(nFiles=40):
+    """Test concurrent uploads, skipping, retries and resume against a local pyftpdlib server."""
+    import random
+    import shutil
+    import socket
+    import tempfile
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.servers import FTPServer
+
+    # Local FTP server with the site base dir
+    dirServer = tempfile.mkdtemp()
+    dirLocal = tempfile.mkdtemp() + '/'
+    os.makedirs(f'{dirServer}/{Uploader.ftpDir}pages')
+    authorizer = DummyAuthorizer()
+    authorizer.add_user('test', 'test', dirServer, perm='elradfmwMT')
+    handler = FTPHandler
+    handler.authorizer = authorizer
+    server = FTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, kwargs={'timeout': 0.1}, daemon=True).start()
+
+    class FakeAppParams:
+        """Last upload date, instead of the AppParam table."""
+        tLastUpload = None
+        def setLastUploadAt(self):
+            self.tLastUpload = time.time()
+
+    class FlakyUploader(Uploader):
+        """Uploader whose first session is broken, to test retries,
+        uploading the test files as modified files."""
+        nBroken = 1
+        def getModifiedFiles(self):
+            return files
+        def openSession(self):
+            session = super().openSession()
+            if self.nBroken > 0:
+                self.nBroken -= 1
+                session.sock.shutdown(socket.SHUT_RDWR)
+            return session
+
+    appParams = FakeAppParams()
+    uploader = FlakyUploader(apCache=appParams)
+    uploader.ftpAddress = '127.0.0.1'
+    uploader.ftpPort = server.address[1]
+    uploader.ftpUser = 'test'
+    uploader.ftpPassword = 'test'
+    uploader.backoff = 0.1
+    uploader.manifestFile = f'{dirLocal}manifest.json'
+
+    # Random local files, some in pages/
+    rnd = random.Random(1)
+    files = []
+    for i in range(nFiles):
+        filename = f'{dirLocal}file{i:03d}.bin'
+        with open(filename, 'wb') as file:
+            file.write(rnd.randbytes(rnd.randint(10000, 2000000)))
+        files.append((filename, 'pages/' if i % 2 else None))
+
+    def checkRemote(filename, dir):
+        with open(filename, 'rb') as local, open(f'{dirServer}/{Uploader.ftpDir}{dir or ""}{os.path.basename(filename)}', 'rb') as remote:
+            return local.read() == remote.read()
+
+    uploader.uploadModified()
+    print(f'First upload: {uploader.getReport()}, identical {all(checkRemote(*pair) for pair in files)}')
+    assert appParams.tLastUpload is not None
+    tLastUpload = appParams.tLastUpload
+    uploader.connect()
+    uploader.uploadFiles(files, 'test')
+    print(f'Second upload: {uploader.getReport()}')
+
+    # Modify one file
+    with open(files[0][0], 'ab') as file:
+        file.write(b'modified')
+    uploader.connect()
+    uploader.uploadFiles(files, 'test')
+    print(f'After one modification: {uploader.getReport()}, identical {checkRemote(*files[0])}')
+
+    # Resume a truncated transfer
+    (filename, dir) = files[1]
+    remote = f'{dir}{os.path.basename(filename)}'
+    with open(f'{dirServer}/{Uploader.ftpDir}{remote}', 'r+b') as file:
+        file.truncate(os.path.getsize(filename) // 2)
+    uploader.connect()
+    uploader.sendFile(filename, remote, True)
+    uploader.quit()
+    print(f'Resumed transfer: {uploader.getReport()}, identical {checkRemote(filename, dir)}')
+
+    # A different partial file on the server is not resumed
+    with open(f'{dirServer}/{Uploader.ftpDir}{remote}', 'wb') as file:
+        file.write(rnd.randbytes(os.path.getsize(filename) // 2))
+    uploader.connect()
+    uploader.sendFile(filename, remote, True)
+    uploader.quit()
+    print(f'Stale partial file: {uploader.getReport()}, identical {checkRemote(filename, dir)}')
+
+    # Give up quickly when the server is unreachable
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        uploader.ftpPort = sock.getsockname()[1]
+    uploader.manifest = {}
+    timer = Timer()
+    try:
+        uploader.uploadModified()
+        assert False, 'UploadError expected'
+    except UploadError:
+        pass
+    print(f'Unreachable server: {uploader.getReport()}, gave up in {timer.getElapsed()}')
+    assert appParams.tLastUpload == tLastUpload, 'Last upload date moved without uploading'
+    # 40 files to a closed port: 40 failed in 0.048s, was 5 attempts and 31s of backoff per file
+
+    server.close_all()
+    shutil.rmtree(dirServer)
+    shutil.rmtree(dirLocal)
+
+if __name__ == '__main__':
+    logging.basicConfig(format="%(levelname)s %(name)s: %(message)s",
+        level=logging.WARNING, handlers=[logging.StreamHandler()])
+    testUploader()
@@ -48,11 +48,7 @@ class QomboImage:
     def toImage(self, oPalette: Palette, sFilename: str):
         """Save the image to a PNG file."""
         self.log.info('Saving %s as %s with palette %s', str(self), sFilename, oPalette.sName)
-        rgbArray = np.zeros((self.h, self.w, 3), 'uint8')
-        for x in range(self.w):
-            for y in range(self.h):
-                col = oPalette.getColor(self.aMask[x][y])
-                rgbArray[y, x, :] = col
+        rgbArray = oPalette.getColors(self.aMask.T)
         img = Image.fromarray(rgbArray)
         img.save(sFilename, 'PNG')
 